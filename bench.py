@@ -0,0 +1,390 @@
+#!/bin/env python3
+# Micro benchmarks for the dice engine. Run as: python bench.py [name ...]
+import sys
+import timeit
+import tracemalloc
+import random
+from random import randrange
+
+import dice
+
+def best(stmt, number=5, repeat=3):
+    return min(timeit.repeat(stmt, number=number, repeat=repeat)) / number
+
+def bench_keep():
+    print("Keeping k of n dice (ms per pool), python lists")
+    print("{:>8} {:>6} {:>6} {:>9} {:>9} {:>9}".format("n", "size", "k", "sort", "heap", "count"))
+    for n in (1000, 100000):
+        for size in (20, 100000):
+            res = [randrange(1, size + 1) for i in range(n)]
+            for k in (1, 10, n // 64, n // 8):
+                sort = best(lambda: sum(sorted(res)[-k:]))
+                heap = best(lambda: sum(dice.heapq.nlargest(k, res)))
+                count = best(lambda: dice.count(res, size)[-k:].total()) if size <= n else float("nan")
+                print("{:>8} {:>6} {:>6} {:>9.3f} {:>9.3f} {:>9.3f}".format(n, size, k, sort * 1000, heap * 1000, count * 1000))
+
+    if dice.np is None:
+        print("numpy is not installed, skipping array pools")
+        return
+    np = dice.np
+    print("Keeping k of n dice (ms per pool), numpy arrays")
+    print("{:>8} {:>6} {:>6} {:>9} {:>9} {:>9}".format("n", "size", "k", "sort", "partition", "bincount"))
+    for n in (1000, 1000000):
+        for size in (20, 100000):
+            res = dice.generator.integers(1, size + 1, size=n)
+            for k in (1, n // 8):
+                sort = best(lambda: int(np.sort(res)[-k:].sum()))
+                part = best(lambda: dice.select(res, k, True, size))
+                count = best(lambda: dice.count(res, size)[-k:].total())
+                print("{:>8} {:>6} {:>6} {:>9.3f} {:>9.3f} {:>9.3f}".format(n, size, k, sort * 1000, part * 1000, count * 1000))
+
+def bench_rng():
+    print("Rolling n dice (us per call), randrange loop vs dice.source")
+    print("{:>8} {:>8} {:>10} {:>10}".format("n", "size", "randrange", "source"))
+    for n in (1, 3, 20, 60, 1000):
+        for size in (6, 20, 100, 1000, 100000):
+            number = max(20000 // n, 10)
+            plain = best(lambda: [randrange(1, size + 1, 1) for i in range(n)], number)
+            buffered = best(lambda: dice.source.dice(n, size), number)
+            print("{:>8} {:>8} {:>10.2f} {:>10.2f}".format(n, size, plain * 1e6, buffered * 1e6))
+
+def bench_memory():
+    import lex_yacc as ly
+    users = 2000
+    macro = "atk = 1d20+7; 1d8+4"
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(users):
+        ly.parsers.parse(macro, ly.Context("user{}".format(i)))
+    stored = tracemalloc.get_traced_memory()[0] - before
+    print("{:.0f} bytes per stored macro ({})".format(stored / users, macro))
+    programs = [x for defs in ly.charDefs.values() for comp in defs.values() for x in comp.exprs]
+    print("{} stored expressions share {} programs, sharing ratio {:.0f}".format(
+        len(programs), len(set(map(id, programs))), len(programs) / len(set(map(id, programs)))))
+
+    # Each user rolls the plain dice expressions of the corpus
+    trees = []
+    for i in range(20):
+        for text in corpus:
+            if ly.fastParser.parse(text) is not None:
+                trees.extend(ly.parse(text, ly.Context("user{}".format(i))))
+    nodes = [x for tree in trees for x in walk(tree)]
+    print("{} nodes in {} parsed trees, {} distinct, sharing ratio {:.1f}".format(
+        len(nodes), len(trees), len(set(map(id, nodes))), len(nodes) / len(set(map(id, nodes)))))
+
+    tree = ly.machine.tree(ly.charDefs["user0"]["atk"].exprs[0])
+    results = []
+    before = tracemalloc.get_traced_memory()[0]
+    blocks = sys.getallocatedblocks()
+    for i in range(users):
+        results.append(tree.execute())
+    print("{:.0f} bytes and {:.1f} allocations kept per evaluated roll".format(
+        (tracemalloc.get_traced_memory()[0] - before) / users, (sys.getallocatedblocks() - blocks) / users))
+    tracemalloc.stop()
+
+def walk(node):
+    import lex_yacc as ly
+    yield node
+    for name in ("left", "right", "amount", "size", "keep", "value"):
+        child = getattr(node, name, None)
+        if isinstance(child, ly.Math_Element):
+            yield from walk(child)
+
+# Structure of an expression tree, used to compare the output of two parsers
+def dump(node):
+    import lex_yacc as ly
+    if not isinstance(node, ly.Math_Element):
+        return node
+    if isinstance(node, ly.Constant):
+        return (type(node.value.res).__name__, node.value.res)
+    if isinstance(node, ly.Math_Element_Comp):
+        return ("Comp", tuple(dump(node.tree(x)) for x in node.exprs))
+    children = [getattr(node, name) for name in ("left", "right", "amount", "size", "keep", "value") if hasattr(node, name)]
+    return (type(node).__name__, getattr(node, "high", None)) + tuple(dump(x) if hasattr(x, "execute") else x for x in children)
+
+def randomExpression(depth):
+    r = random.random()
+    if depth <= 0 or r < 0.25:
+        return random.choice(["1", "2", "20", "0", "3.5", ".5", "(1d4)", "(2*3)"])
+    if r < 0.45:
+        roll = "{}d{}".format(randomExpression(0), randomExpression(0))
+        if random.random() < 0.4:
+            roll += random.choice("hl") + randomExpression(0)
+        return roll
+    if r < 0.55:
+        return random.choice("-+") + randomExpression(depth - 1)
+    if r < 0.65:
+        return "(" + randomExpression(depth - 1) + ")"
+    return randomExpression(depth - 1) + random.choice(["+", "-", "*", "/", " + ", "- "]) + randomExpression(depth - 1)
+
+def mangle(text):
+    pos = random.randrange(len(text) + 1)
+    return text[:pos] + random.choice(["", "d", "h", ")", "(", "+", "dd", "x", ";", " ", "roll ", "1"]) + text[pos:]
+
+def parseBoth(ly, text, context):
+    try:
+        slow = [dump(x) for x in ly.parsers.parse(text, context)]
+    except ly.SyntaxError:
+        slow = None
+    fast = ly.fastParser.parse(text)
+    return slow, None if fast is None else [dump(fast.simplify())]
+
+def bench_fastparse():
+    import lex_yacc as ly
+    import io, contextlib
+    context = ly.Context("bench")
+    random.seed(1)
+    cases = ["1d20+5", "roll 1d20+5", "4d6h3", "-2d6+3", "2d6 + 1d4 * 2", "(1d4)d6l1", "--2", "1d6/-2"]
+    cases += [randomExpression(4) for i in range(3000)]
+    cases += [mangle(random.choice(cases)) for i in range(3000)]
+    fastHits = mismatches = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = [(text, parseBoth(ly, text, context)) for text in cases]
+    for text, (slow, fast) in results:
+        if fast is None:
+            continue
+        fastHits += 1
+        if slow != fast:
+            mismatches += 1
+            print("MISMATCH {!r}: PLY {} fast {}".format(text, slow, fast))
+    print("{} inputs, {} handled by the fast parser, {} mismatches".format(len(cases), fastHits, mismatches))
+
+    print("Parse latency (us per message)")
+    print("{:>24} {:>8} {:>8}".format("message", "PLY", "fast"))
+    for text in ["1d20+5", "roll 1d20+5", "4d6h3+2d8-1", "(1d4)d6 + 2*(3d6l1) - 5"]:
+        slow = best(lambda: ly.parsers.parse(text, context), 2000)
+        fast = best(lambda: ly.fastParser.parse(text), 2000)
+        print("{:>24} {:>8.2f} {:>8.2f}".format(text, slow * 1e6, fast * 1e6))
+
+def bench_bytecode():
+    import lex_yacc as ly
+    import io, contextlib
+    context = ly.Context("bench")
+    print("Evaluating an expression (us per roll)")
+    print("{:>24} {:>6} {:>8} {:>8} {:>8}".format("expression", "bytes", "tree", "bytecode", "compiled"))
+    with contextlib.redirect_stdout(io.StringIO()):
+        for text in ["7+2*3", "1d20+7", "1d20+7+2d6+1d4", "4d6h3+2*1d8-1", "(1d4)d6 + 2*(3d6l1) - 5"]:
+            tree = ly.parse(text, context)[0]
+            program = ly.machine.lower(tree)
+            compiled = ly.compileExpression(tree)
+            times = [best(f, 20000, 5) for f in (tree.execute, lambda: ly.machine.run(program), compiled)]
+            print("{:>24} {:>6} {:>8.2f} {:>8.2f} {:>8.2f}".format(text, len(program.dumps()), *[x * 1e6 for x in times]), file=sys.__stdout__)
+
+    macro = ly.machine.lower(ly.parse("1d20+7+2d6+1d4", context)[0])
+    data = macro.dumps()
+    print("Loading a stored macro (us): bytecode {:.2f}, tree {:.2f}".format(
+        best(lambda: ly.machine.loads(data), 20000, 5) * 1e6, best(lambda: ly.machine.tree(macro), 20000, 5) * 1e6))
+
+# Commands as they are typed in the channels
+corpus = [
+    "roll 1d20+5", "1d20+7", "4d6h3", "2d20h1+3", "2d20l1-1", "8d6", "1d8+4; 1d6+2", "roll 3d6",
+    "atk = 1d20+7; 1d8+4", "atk", "dmg", "stealth", "perception", "dist 2d6+3", "sim 10000 1d20+5, 15",
+    "dminit", "dminit(goblin, orc)", "help", "reread", "loadcon(dnd5e)", "(1d4)d6 + 2*(3d6l1) - 5",
+    "fireball = 8d6; 8d6/2", "10d10h5 + 1d4 - 2", "roll 1d100", "1d20 + 1d4 + 3; 2d6 + 1d8 + 5",
+]
+
+def lexAll(lexer, texts):
+    count = 0
+    for text in texts:
+        lexer.input(text)
+        while lexer.token() is not None:
+            count += 1
+    return count
+
+def bench_lex():
+    import lex_yacc as ly
+    texts = corpus * 40
+    plain = ly.lexer.clone()
+    fast = ly.fastLexer.clone()
+    # Scans every message again
+    cold = ly.fastLexer.clone()
+    cold.cached = cold.scan
+    count = lexAll(plain, texts)
+    print("Lexing {} commands, {} tokens (tokens per second)".format(len(texts), count))
+    print("{:>12} {:>12} {:>12}".format("PLY", "scan", "cached"))
+    times = [best(lambda: lexAll(plain, texts), 10),
+        best(lambda: lexAll(cold, texts), 10),
+        best(lambda: lexAll(fast, texts), 10)]
+    print("{:>12,.0f} {:>12,.0f} {:>12,.0f}".format(*[count / x for x in times]))
+
+def bench_procpool():
+    import lex_yacc as ly
+    import procpool
+    import io, contextlib
+    from concurrent.futures import ThreadPoolExecutor
+    text = "200000d100000h10"
+    messages = 32
+    context = ly.Context("bench")
+    print("{} messages of {} on 4 threads (messages per second)".format(messages, text))
+    for processes in (0, 2, 4):
+        procpool.start(processes)
+        with contextlib.redirect_stdout(io.StringIO()), ThreadPoolExecutor(4) as threads:
+            # The first roll starts the workers
+            list(threads.map(lambda i: ly.evaluate(text, context), range(8)))
+            start = timeit.default_timer()
+            list(threads.map(lambda i: ly.evaluate(text, context), range(messages)))
+            elapsed = timeit.default_timer() - start
+        print("{:>2} processes: {:8.1f}".format(processes, messages / elapsed))
+    procpool.stop()
+
+# Definitions, then the macros that are timed. bb and cc use a macro that is stored as a
+# macro, cc also mixes it with bytecode.
+macroDefinitions = ["atk = 1d20+7; 1d8+4", "bb = atk", "cc = atk; 1d6", "big = 300d6h3+2"]
+macroCases = ["atk", "bb", "roll bb", "cc", "big"]
+
+def bench_macros():
+    import lex_yacc as ly
+    import io, contextlib
+    context = ly.Context("bench")
+    print("{:>8} {:>10}  {}".format("macro", "us", "result"))
+    with contextlib.redirect_stdout(io.StringIO()):
+        for text in macroDefinitions:
+            ly.evaluate(text, context)
+        for text in macroCases:
+            result = ly.evaluate(text, context).replace("\n", " | ")
+            elapsed = best(lambda: ly.evaluate(text, context), 2000)
+            print("{:>8} {:>10.2f}  {}".format(text, elapsed * 1e6, result[:60]), file=sys.__stdout__)
+
+# Messages that try to get more dice past the cost estimate than maxWork allows
+costCases = [
+    "+".join(["999999d100001"] * 6),
+    "(200000/((1d3-2)/5))d100001",
+    "; ".join(["(200000/((1d3-2)/5))d100001"] * 24),
+    "dminit(" + ", ".join(["999999d100001"] * 120) + ")",
+    "; ".join(["dminit(" + ", ".join(["999999d100001"] * 4) + ")"] * 2),
+    "sim 10 1d20, " + "+".join(["999999d100001"] * 6),
+    "sim 1000000 10000d10000",
+    "sim 100 999999d100001",
+    "sim 10000 1d20+5, 15",
+    "1000d6+1000d6",
+]
+
+def bench_cost():
+    import lex_yacc as ly
+    import io, contextlib
+    context = ly.Context("bench")
+    print("{:>48} {:>12} {:>9}  {}".format("message", "estimate", "ms", "result"))
+    for text in costCases:
+        with contextlib.redirect_stdout(io.StringIO()):
+            # Statements that roll while parsing are not part of the estimate
+            try:
+                estimate = "{:,}".format(ly.statementCost(ly.parsers.parse(text, ly.Context("estimate"))).work)
+            except (ly.SyntaxError, ly.cost.CostError):
+                estimate = "-"
+            start = timeit.default_timer()
+            try:
+                ly.evaluate(text, context)
+                result = "rolled"
+            except ly.SyntaxError as e:
+                result = e.message
+        elapsed = timeit.default_timer() - start
+        shown = text if len(text) <= 48 else text[:45] + "..."
+        print("{:>48} {:>12} {:>9.1f}  {}".format(shown, estimate, elapsed * 1000, result))
+
+# Stands in for PDFtoJSON, only accepts files that look like a pdf
+fakeConverter = """#!{}
+import sys, shutil, time
+time.sleep({})
+with open(sys.argv[1], 'rb') as pdf:
+    if not pdf.read(4) == b'%PDF':
+        sys.exit(1)
+shutil.copyfile({!r}, sys.argv[2])
+"""
+
+fakeSheet = {
+    "basic_info": {"Character_Name": "Bob"},
+    "savingthrows": {"Fort": {"Total": 3}, "Ref": {"Total": 2}, "Will": {"Total": 1}},
+    "stats": {"init": {"total": 4}},
+    "skill": {"Stealth": {"Total": 7}, "Knowledge": {}},
+}
+
+# ?read against a local HTTP server, with a script in place of PDFtoJSON and everything
+# written to a temporary directory
+def bench_ingest():
+    import lex_yacc as ly
+    import ingest
+    import asyncio, functools, http.server, io, contextlib, json, os, stat, tempfile, threading
+
+    class Attachment:
+        def __init__(self, url):
+            self.url = url
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sheet = os.path.join(tmp, "sheet.json")
+        with open(sheet, 'w') as jfile:
+            json.dump(fakeSheet, jfile)
+        with open(os.path.join(tmp, "sheet.pdf"), 'wb') as pfile:
+            pfile.write(b"%PDF-1.4 " + os.urandom(100000))
+        with open(os.path.join(tmp, "other.pdf"), 'wb') as pfile:
+            pfile.write(b"%PDF-1.4 " + os.urandom(100000))
+        converter = os.path.join(tmp, "PDFtoJSON")
+        with open(converter, 'w') as cfile:
+            cfile.write(fakeConverter.format(sys.executable, 0.5, sheet))
+        os.chmod(converter, os.stat(converter).st_mode | stat.S_IEXEC)
+        ingest.converter = converter
+        ingest.directory = os.path.join(tmp, "files")
+        ly.characters.path = os.path.join(tmp, "characters.db")
+
+        handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=tmp)
+        handler.func.log_message = lambda *args: None
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = "http://127.0.0.1:{}/".format(server.server_port)
+
+        async def read(author, name):
+            context = ly.Context(author, [Attachment(base + name)])
+            lines = []
+            for line in ly.stream("read", context):
+                lines.append(await line.run() if isinstance(line, ingest.ReadJob) else line)
+            return "\n".join(lines)
+
+        # How late the event loop wakes up while the reads run
+        async def lag(done):
+            worst = 0.0
+            while not done.is_set():
+                start = timeit.default_timer()
+                await asyncio.sleep(0.01)
+                worst = max(worst, timeit.default_timer() - start - 0.01)
+            return worst
+
+        async def batch(title, reads):
+            done = asyncio.Event()
+            monitor = asyncio.ensure_future(lag(done))
+            start = timeit.default_timer()
+            with contextlib.redirect_stdout(io.StringIO()):
+                res = await asyncio.gather(*[read(author, name) for author, name in reads])
+            elapsed = timeit.default_timer() - start
+            done.set()
+            print("{:<36} {:>8.2f} s, worst loop lag {:6.1f} ms: {}".format(
+                title, elapsed, await monitor * 1000, ", ".join(sorted(set(res)))))
+
+        async def main():
+            print("?read with a converter that takes 0.5 s, {} at a time".format(ingest.maxConversions))
+            await batch("8 users, same pdf", [("user{}".format(i), "sheet.pdf") for i in range(8)])
+            await batch("8 users, same pdf again", [("user{}".format(i), "sheet.pdf") for i in range(8)])
+            await batch("4 users, new pdf", [("user{}".format(i), "other.pdf") for i in range(4)])
+            await batch("missing pdf", [("user0", "missing.pdf")])
+            await batch("not a pdf", [("user0", "sheet.json")])
+
+        asyncio.run(main())
+        with contextlib.redirect_stdout(io.StringIO()):
+            reread = ly.evaluate("reread", ly.Context("user0"))
+        print("reread: {}, files left: {}".format(reread, sorted(os.listdir(ingest.directory))))
+        server.shutdown()
+
+benchmarks = {
+    "keep": bench_keep,
+    "rng": bench_rng,
+    "memory": bench_memory,
+    "fastparse": bench_fastparse,
+    "bytecode": bench_bytecode,
+    "lex": bench_lex,
+    "procpool": bench_procpool,
+    "macros": bench_macros,
+    "cost": bench_cost,
+    "ingest": bench_ingest,
+}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or benchmarks:
+        benchmarks[name]()
@@ -0,0 +1,174 @@
+#!/bin/env python3
+import marshal
+import threading
+import weakref
+
+# Stack machine for roll expressions. A program is a bytes buffer of (opcode, argument)
+# pairs and a tuple of int and float constants. The serialized form is the marshalled
+# (version, code, constants) tuple, which is also what programs are compared and hashed by.
+
+version = 1
+
+CONST, ROLL, KEEPH, KEEPL, ADD, SUB, MUL, DIV, NEG, NONZERO = range(10)
+
+names = ("CONST", "ROLL", "KEEPH", "KEEPL", "ADD", "SUB", "MUL", "DIV", "NEG", "NONZERO")
+
+# Raised for trees that have no bytecode form, they keep being executed as trees
+class Unsupported(Exception):
+    pass
+
+class Program:
+    __slots__ = ("code", "consts", "values", "compiled", "__weakref__")
+
+    # values are the constants as RollResults, so pushing one does not allocate
+    def __init__(self, code, consts, values):
+        self.code = code
+        self.consts = consts
+        self.values = values
+        # Cache for whoever executes the program, see Machine.share
+        self.compiled = None
+
+    def dumps(self):
+        return marshal.dumps((version, self.code, self.consts))
+
+    def __eq__(self, other):
+        return isinstance(other, Program) and self.dumps() == other.dumps()
+
+    def __hash__(self):
+        return hash(self.dumps())
+
+    def __len__(self):
+        return len(self.code) // 2
+
+    def __str__(self):
+        code = self.code
+        lines = []
+        for i in range(0, len(code), 2):
+            if code[i] == CONST:
+                lines.append("CONST {!r}".format(self.consts[code[i + 1]]))
+            else:
+                lines.append(names[code[i]])
+        return "\n".join(lines)
+
+class Assembler:
+    def __init__(self):
+        self.code = bytearray()
+        self.consts = []
+        self.index = {}
+
+    def op(self, opcode, arg=0):
+        self.code.append(opcode)
+        self.code.append(arg)
+
+    # 1 and 1.0 are equal but print differently, so constants are told apart by type
+    def const(self, value):
+        if type(value) not in (int, float):
+            raise Unsupported("Constant {!r} has no bytecode form".format(value))
+        key = (type(value), repr(value))
+        if not key in self.index:
+            if len(self.consts) > 255:
+                raise Unsupported("Too many constants")
+            self.index[key] = len(self.consts)
+            self.consts.append(value)
+        self.op(CONST, self.index[key])
+
+class Machine:
+    # nodes is the module that defines RollResult and the dice functions
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.programs = weakref.WeakValueDictionary()
+        self.lock = threading.Lock()
+
+    def load(self, code, consts):
+        RollResult = self.nodes.RollResult
+        return Program(bytes(code), tuple(consts), tuple(RollResult(x, "") for x in consts))
+
+    def lower(self, tree):
+        asm = Assembler()
+        tree.lower(asm)
+        return self.load(asm.code, asm.consts)
+
+    # Equal programs are stored once, along with what is cached on them
+    def share(self, program):
+        key = program.dumps()
+        with self.lock:
+            res = self.programs.get(key)
+            if res is None:
+                self.programs[key] = res = program
+            return res
+
+    # Rebuilds the expression tree, the divisor of DIV lies below the dividend
+    def tree(self, program):
+        nodes = self.nodes
+        binops = {ADD: nodes.Add, SUB: nodes.Sub, MUL: nodes.Mul}
+        stack = []
+        code = program.code
+        for i in range(0, len(code), 2):
+            op = code[i]
+            if op == CONST:
+                stack.append(nodes.Constant(program.values[code[i + 1]]))
+            elif op in binops:
+                right = stack.pop()
+                stack[-1] = binops[op](stack[-1], right)
+            elif op == DIV:
+                left = stack.pop()
+                stack[-1] = nodes.Div(left, stack[-1])
+            elif op == ROLL:
+                size = stack.pop()
+                stack[-1] = nodes.Roll(stack[-1], size)
+            elif op == KEEPH or op == KEEPL:
+                keep = stack.pop()
+                size = stack.pop()
+                stack[-1] = nodes.ComplicatedRoll(stack[-1], size, keep, op == KEEPH)
+            elif op == NEG:
+                stack[-1] = nodes.UnMinus(stack[-1])
+        return stack[-1]
+
+    def loads(self, data):
+        tag, code, consts = marshal.loads(data)
+        if tag != version:
+            raise ValueError("Bytecode version {} is not supported".format(tag))
+        return self.load(code, consts)
+
+    def run(self, program):
+        nodes = self.nodes
+        RollResult = nodes.RollResult
+        concat = nodes.concat
+        values = program.values
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        it = iter(program.code)
+        for op, arg in zip(it, it):
+            if op == CONST:
+                push(values[arg])
+            elif op == ADD:
+                right = pop()
+                stack[-1] = stack[-1] + right
+            elif op == SUB:
+                right = pop()
+                stack[-1] = stack[-1] - right
+            elif op == ROLL:
+                size = pop()
+                amount = stack[-1]
+                total, rolls = nodes.rollDice(amount.res, size.res)
+                stack[-1] = RollResult(total, concat(amount.roll, size.roll, rolls))
+            elif op == KEEPH or op == KEEPL:
+                keep = pop()
+                size = pop()
+                amount = stack[-1]
+                total, rolls = nodes.keepDice(amount.res, size.res, keep.res, op == KEEPH)
+                stack[-1] = RollResult(total, concat(amount.roll, size.roll, keep.roll, rolls))
+            elif op == MUL:
+                right = pop()
+                stack[-1] = stack[-1] * right
+            # The divisor is evaluated first and sits below the dividend
+            elif op == DIV:
+                left = pop()
+                stack[-1] = left / stack[-1]
+            elif op == NONZERO:
+                if stack[-1].res == 0:
+                    raise nodes.SyntaxError("Cannot divide by zero")
+            elif op == NEG:
+                stack[-1] = -stack[-1]
+        return stack[-1]
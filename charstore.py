@@ -0,0 +1,102 @@
+#!/bin/env python3
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# Characters are stored in SQLite, one row per user and character. The character a user
+# read last is the active one, it is what identifiers and dminit use, and all of them are
+# a single indexed query. Nothing is opened or loaded before the first lookup, users are
+# read in as their rows are needed.
+
+path = os.environ.get("DIEBOT_DB", os.path.join("files", "characters.db"))
+# Active characters kept in memory, the least recently used ones are dropped first
+maxCached = int(os.environ.get("DIEBOT_CHARACTERS", "1024"))
+
+schema = """
+create table if not exists characters (
+    user text not null,
+    name text not null,
+    active integer not null default 1,
+    stats text not null,
+    primary key (user, name)
+);
+create index if not exists characters_active on characters (active);
+"""
+
+class CharacterStore:
+    def __init__(self, path, maxsize):
+        self.path = path
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Bumped by every put, a lookup that raced with one does not cache what it read
+        self.writes = 0
+        # sqlite3 connections can not be shared between threads
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10)
+            # Readers do not wait for the writer
+            conn.execute("pragma journal_mode=wal")
+            conn.execute("pragma synchronous=normal")
+            conn.executescript(schema)
+            self.local.conn = conn
+        return conn
+
+    def remember(self, user, character, writes=None):
+        with self.lock:
+            if writes is not None and writes != self.writes:
+                return
+            self.entries[user] = character
+            self.entries.move_to_end(user)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    # The active character of user, or None. Users without one are cached as well, so
+    # unknown identifiers do not go to the database every time.
+    def get(self, user):
+        with self.lock:
+            if user in self.entries:
+                self.entries.move_to_end(user)
+                self.hits += 1
+                return self.entries[user]
+            self.misses += 1
+            writes = self.writes
+        row = self.connection().execute(
+            "select stats from characters where user = ? and active = 1", (user,)).fetchone()
+        character = json.loads(row[0]) if row is not None else None
+        self.remember(user, character, writes)
+        return character
+
+    # Stores the character and makes it the active one of user
+    def put(self, user, character):
+        conn = self.connection()
+        with conn:
+            conn.execute("update characters set active = 0 where user = ? and name != ?", (user, character["name"]))
+            conn.execute(
+                "insert or replace into characters (user, name, active, stats) values (?, ?, 1, ?)",
+                (user, character["name"], json.dumps(character)))
+        with self.lock:
+            self.writes += 1
+        self.remember(user, character)
+
+    # The active characters of all users
+    def party(self):
+        rows = self.connection().execute("select stats from characters where active = 1")
+        return [json.loads(row[0]) for row in rows]
+
+    def lookups(self):
+        return self.hits + self.misses
+
+    def __str__(self):
+        hitRate = self.hits / self.lookups() if self.lookups() else 0.0
+        return "Characters: {} cached, {:.1%} hit rate over {} lookups".format(len(self.entries), hitRate, self.lookups())
@@ -0,0 +1,115 @@
+#!/bin/env python3
+from math import inf, isfinite
+
+import dice
+
+# Upper bounds on what evaluating an expression costs, computed from the tree before any
+# die is rolled. Values are tracked as intervals, so (1000d1000)d6 is known to roll at
+# most 1001000 dice. work counts the dice that are generated one by one, a histogram
+# pool only costs one unit per face.
+
+# Roughly 50ms of rolling
+maxWork = 5000000
+# Transcripts are kept in memory until they are sent
+maxTranscript = 20000
+# Messages above this much work are worth moving off the event loop
+heavyWork = 100000
+
+# Length of a record that omits its dice, and of the markup around the result
+omittedRecord = 52
+resultMarkup = 12
+
+class CostError(Exception):
+    def __init__(self, message):
+        super().__init__()
+        self.message = message
+
+class Cost:
+    __slots__ = ("lo", "hi", "dice", "work", "transcript")
+
+    def __init__(self, lo, hi, dice, work, transcript):
+        self.lo = lo
+        self.hi = hi
+        self.dice = dice
+        self.work = work
+        self.transcript = transcript
+
+    def heavy(self):
+        return self.work > heavyWork
+
+    def __str__(self):
+        return "values in [{}, {}], at most {:,} dice, {:,} work, {:,} characters".format(
+            self.lo, self.hi, self.dice, self.work, self.transcript)
+
+def constant(value):
+    return Cost(value, value, 0, 0, 0)
+
+# Products where one side is 0 are 0, even if the other side is unbounded
+def product(x, y):
+    return x * y if x and y else 0
+
+def combine(left, right, op):
+    if op == "+":
+        lo, hi = left.lo + right.lo, left.hi + right.hi
+    elif op == "-":
+        lo, hi = left.lo - right.hi, left.hi - right.lo
+    else:
+        corners = [product(x, y) for x in (left.lo, left.hi) for y in (right.lo, right.hi)]
+        lo, hi = min(corners), max(corners)
+    return Cost(lo, hi, left.dice + right.dice, left.work + right.work, left.transcript + right.transcript + 2)
+
+# Dividing by zero fails, so an integral divisor is at least 1 away from it
+def divide(left, right, integral):
+    if right.lo > 0 or right.hi < 0:
+        corners = [x / y for x in (left.lo, left.hi) for y in (right.lo, right.hi)]
+        lo, hi = min(corners), max(corners)
+    elif integral:
+        bound = max(abs(left.lo), abs(left.hi))
+        lo, hi = -bound, bound
+    else:
+        lo, hi = -inf, inf
+    return Cost(lo, hi, left.dice + right.dice, left.work + right.work, left.transcript + right.transcript + 2)
+
+def negate(cost):
+    return Cost(-cost.hi, -cost.lo, cost.dice, cost.work, cost.transcript)
+
+# Amounts and sizes are truncated like in rollDice
+def truncate(lo, hi, what):
+    if not isfinite(lo) or not isfinite(hi):
+        raise CostError("Cannot bound the {} of dice in this roll".format(what))
+    return int(lo), int(hi)
+
+# Cost of rolling amount dice with size faces, keep is the cost of the keep expression
+def roll(amount, size, keep=None):
+    parts = [amount, size] if keep is None else [amount, size, keep]
+    lo, hi = truncate(amount.lo, amount.hi, "amount")
+    sizes = truncate(size.lo, size.hi, "size")
+    most = max(abs(lo), abs(hi))
+    faces = max(sizes[1], 0)
+    fewest = 0 if lo <= 0 <= hi else min(abs(lo), abs(hi))
+
+    # A histogram is only used if every possible pool qualifies for one
+    if dice.generator is not None and dice.histogram(fewest, faces) and dice.histogram(most, faces):
+        work = faces
+    else:
+        work = most
+    # Every die shows at least 1 if the size is positive, a zero size rolls nothing
+    vlo = lo if lo > 0 else lo * faces
+    vhi = hi * faces if hi > 0 else hi
+    if keep is not None or sizes[0] < 1:
+        vlo, vhi = min(vlo, 0), max(vhi, 0)
+    record = max(min(most, 199) * (len(str(faces)) + 2), omittedRecord)
+    if keep is not None:
+        record += 8
+    return Cost(vlo, vhi, most + sum(x.dice for x in parts),
+        work + sum(x.work for x in parts), record + sum(x.transcript for x in parts))
+
+# Cost of evaluating an expression trials times when only a summary is shown
+def repeat(cost, trials):
+    return Cost(cost.lo, cost.hi, cost.dice * trials, cost.work * trials, 0)
+
+def check(cost):
+    if cost.work > maxWork:
+        raise CostError("Will not roll this, it could take up to {:,} dice".format(cost.dice))
+    if cost.transcript > maxTranscript:
+        raise CostError("Will not roll this, the result could be up to {:,} characters long".format(cost.transcript))
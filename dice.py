@@ -0,0 +1,228 @@
+#!/bin/env python3
+import random
+from random import randrange, randbytes
+import heapq
+from threading import RLock
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Below this many dice the setup cost of an array outweighs the buffered byte path
+vectorThreshold = 64
+# Keeps the sum of an int64 pool from overflowing
+int64Limit = 2 ** 63
+
+# Pools that are too big to be displayed are only kept as per-face counts
+histogramThreshold = 200
+histogramFaces = 10000
+
+# Unsorted pools with at most this many faces are counted instead of sorted
+countingFaces = 1000
+# Keeping k of n dice uses a heap if k * selectionRatio < n, otherwise a full sort
+selectionRatio = 64
+
+maxPool = 1000000
+maxHistogram = 10 ** 12
+
+# Random bytes are fetched from the Mersenne Twister in blocks of this size
+blockSize = 65536
+
+generator = np.random.default_rng() if np is not None else None
+
+# Hands out dice from a buffer of random bytes that is refilled in bulk. Bytes (or 32 bit
+# words for bigger dice) that would make the modulo biased are dropped before they are used.
+class DiceSource:
+    def __init__(self, blockSize):
+        self.blockSize = blockSize
+        self.buffer = b""
+        self.pos = 0
+        self.tables = {}
+        # The buffer and the numpy generator are shared by every thread that rolls
+        self.lock = RLock()
+
+    def bytes(self, n):
+        with self.lock:
+            if self.pos + n > len(self.buffer):
+                self.buffer = self.buffer[self.pos:] + randbytes(max(self.blockSize, n))
+                self.pos = 0
+            res = self.buffer[self.pos:self.pos + n]
+            self.pos += n
+            return res
+
+    # Translation table from a byte to a face, and the bytes that have to be rejected
+    def table(self, size):
+        if not size in self.tables:
+            limit = 256 - 256 % size
+            self.tables[size] = (bytes(i % size + 1 for i in range(256)), bytes(range(limit, 256)), limit)
+        return self.tables[size]
+
+    def smallDice(self, amount, size):
+        table, rejected, limit = self.table(size)
+        res = []
+        while len(res) < amount:
+            missing = amount - len(res)
+            res.extend(self.bytes(missing + missing * (256 - limit) // limit + 1).translate(table, rejected))
+        del res[amount:]
+        return res
+
+    def wordDice(self, amount, size):
+        limit = 2 ** 32 - 2 ** 32 % size
+        res = []
+        while len(res) < amount:
+            missing = amount - len(res)
+            words = memoryview(self.bytes(4 * (missing + missing * (2 ** 32 - limit) // limit + 1))).cast("I")
+            res.extend(x % size + 1 for x in words if x < limit)
+        del res[amount:]
+        return res
+
+    def dice(self, amount, size):
+        if size < 1:
+            raise ValueError("empty range for randrange({}, {}, 1)".format(1, size + 1))
+        if amount == 1 and size < 256:
+            return [self.die(size)]
+        if vectorized(amount, size):
+            with self.lock:
+                return generator.integers(1, size + 1, size=amount)
+        if size < 256:
+            return self.smallDice(amount, size)
+        if size <= 2 ** 32:
+            return self.wordDice(amount, size)
+        return [randrange(1, size + 1, 1) for i in range(amount)]
+
+    def die(self, size):
+        if not 0 < size < 256:
+            return self.dice(1, size)[0]
+        table, rejected, limit = self.table(size)
+        with self.lock:
+            while True:
+                if self.pos >= len(self.buffer):
+                    self.buffer = randbytes(self.blockSize)
+                    self.pos = 0
+                byte = self.buffer[self.pos]
+                self.pos += 1
+                if byte < limit:
+                    return table[byte]
+
+    # A (trials, amount) block of dice, only used with numpy
+    def block(self, trials, amount, size):
+        with self.lock:
+            return generator.integers(1, size + 1, size=(trials, amount))
+
+    # How many of amount dice show each face
+    def counts(self, amount, size, trials=None):
+        if generator is not None:
+            with self.lock:
+                return generator.multinomial(amount, [1.0 / size] * size, size=trials)
+        counts = [0] * size
+        for start in range(0, amount, maxPool):
+            for x in self.dice(min(maxPool, amount - start), size):
+                counts[x - 1] += 1
+        return counts
+
+source = DiceSource(blockSize)
+
+# Restarts the dice of this process from a seed, worker processes roll from a seed they
+# get with the expression
+def seed(value):
+    global generator
+    with source.lock:
+        random.seed(value)
+        source.buffer = b""
+        source.pos = 0
+        if np is not None:
+            generator = np.random.default_rng(value)
+
+class Histogram:
+    # counts[i] is the number of dice that show i + 1
+    def __init__(self, counts):
+        self.counts = counts
+        self.amount = sum(counts)
+
+    def __len__(self):
+        return self.amount
+
+    def sort(self):
+        pass
+
+    # Slices the pool as if it was a sorted list of dice
+    def __getitem__(self, index):
+        start, stop, step = index.indices(self.amount)
+        counts = []
+        pos = 0
+        for count in self.counts:
+            counts.append(max(0, min(stop, pos + count) - max(start, pos)))
+            pos += count
+        return Histogram(counts)
+
+    def total(self):
+        return sum(face * count for face, count in enumerate(self.counts, 1))
+
+    def tolist(self):
+        res = []
+        for face, count in enumerate(self.counts, 1):
+            res.extend([face] * count)
+        return res
+
+def vectorized(amount, size):
+    return generator is not None and amount >= vectorThreshold and amount * size < int64Limit
+
+def histogram(amount, size):
+    return amount >= histogramThreshold and amount >= size and size <= histogramFaces
+
+def limit(amount, size):
+    if generator is not None and histogram(amount, size):
+        return maxHistogram
+    return maxPool
+
+def roll(amount, size):
+    if histogram(amount, size):
+        return Histogram(toList(source.counts(amount, size)))
+    return source.dice(amount, size)
+
+def total(res):
+    if isinstance(res, Histogram):
+        return res.total()
+    if np is not None and isinstance(res, np.ndarray):
+        return int(res.sum())
+    return sum(res)
+
+def toList(res):
+    if isinstance(res, Histogram) or (np is not None and isinstance(res, np.ndarray)):
+        return res.tolist()
+    return res
+
+def count(res, size):
+    if np is not None and isinstance(res, np.ndarray):
+        return Histogram(np.bincount(res, minlength=size + 1)[1:].tolist())
+    counts = [0] * size
+    for x in res:
+        counts[x - 1] += 1
+    return Histogram(counts)
+
+# Sum of the keep highest (or lowest) dice, without sorting the pool where possible
+def select(res, keep, high, size):
+    amount = len(res)
+    keep = min(keep, amount)
+    if keep == 0:
+        return 0
+    if np is not None and isinstance(res, np.ndarray):
+        if high:
+            return int(np.partition(res, amount - keep)[amount - keep:].sum())
+        return int(np.partition(res, keep - 1)[:keep].sum())
+    if keep * selectionRatio < amount:
+        return sum(heapq.nlargest(keep, res) if high else heapq.nsmallest(keep, res))
+    if size <= countingFaces and amount >= size:
+        res = count(res, size)
+        return total(res[-keep:] if high else res[:keep])
+    res = sorted(res)
+    return sum(res[-keep:] if high else res[:keep])
+
+# Same result as summing res[-keep:] (high) or res[:keep] (low) of the sorted pool
+def keepTotal(res, keep, high, size):
+    if isinstance(res, Histogram):
+        return total(res[-keep:] if high else res[:keep])
+    if keep < 0:
+        return total(res) - select(res, -keep, not high, size)
+    return select(res, keep, high, size)
@@ -0,0 +1,166 @@
+#!/bin/env python3
+from functools import lru_cache
+from math import comb, sqrt
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Distributions are dicts mapping an outcome to its probability. The cached ones are
+# shared between queries, so they must never be modified in place.
+
+maxSupport = 100000
+maxWork = 20000000
+cacheSize = 256
+
+class DistributionError(Exception):
+    def __init__(self, message):
+        super().__init__()
+        self.message = message
+
+def constant(value):
+    return {value: 1.0}
+
+def check(work):
+    if work > maxWork:
+        raise DistributionError("Expression is too complex to compute its distribution")
+
+def checkSupport(support):
+    if support > maxSupport:
+        raise DistributionError("Expression has too many possible outcomes")
+
+def combine(left, right, op):
+    check(len(left) * len(right))
+    res = {}
+    for lv, lp in left.items():
+        for rv, rp in right.items():
+            v = op(lv, rv)
+            res[v] = res.get(v, 0.0) + lp * rp
+    checkSupport(len(res))
+    return res
+
+def negate(dist):
+    return {-v: p for v, p in dist.items()}
+
+def mix(parts):
+    res = {}
+    for weight, dist in parts:
+        for v, p in dist.items():
+            res[v] = res.get(v, 0.0) + weight * p
+    checkSupport(len(res))
+    return res
+
+def convolve(a, b):
+    if np is not None:
+        return np.convolve(a, b).tolist()
+    check(len(a) * len(b))
+    res = [0.0] * (len(a) + len(b) - 1)
+    for i, x in enumerate(a):
+        for j, y in enumerate(b):
+            res[i + j] += x * y
+    return res
+
+def checkRoll(amount, size):
+    if size < 0:
+        raise DistributionError("Cannot roll dice with a negative number of sides")
+    checkSupport(abs(amount) * (size - 1) + 1)
+
+# Sum of amount dice with size faces
+@lru_cache(maxsize=cacheSize)
+def roll(amount, size):
+    if size == 0 or amount == 0:
+        return constant(0)
+    checkRoll(amount, size)
+
+    # Square and multiply, probs[i] is the probability of rolling n + i
+    n = abs(amount)
+    die = [1.0 / size] * size
+    probs = [1.0]
+    while n:
+        if n & 1:
+            probs = convolve(probs, die)
+        n >>= 1
+        if n:
+            die = convolve(die, die)
+
+    sign = -1 if amount < 0 else 1
+    return {sign * (abs(amount) + i): p for i, p in enumerate(probs) if p > 0}
+
+# Sum of the keep highest dice, faces are handed out from the highest down.
+# states maps (dice placed, kept sum) to its probability while fewer than keep dice are placed.
+def keepHighest(amount, size, keep):
+    check(keep * keep * size * size * amount)
+    res = {}
+    states = {(0, 0): 1.0}
+    for face in range(size, 0, -1):
+        p = 1.0 / face
+        nxt = {}
+        for (placed, kept), prob in states.items():
+            left = amount - placed
+            for j in range(left + 1) if face > 1 else (left,):
+                pj = 1.0 if face == 1 else comb(left, j) * p ** j * (1 - p) ** (left - j)
+                if pj == 0.0:
+                    continue
+                total = kept + face * min(j, keep - placed)
+                if placed + j >= keep:
+                    res[total] = res.get(total, 0.0) + prob * pj
+                else:
+                    key = (placed + j, total)
+                    nxt[key] = nxt.get(key, 0.0) + prob * pj
+        states = nxt
+    return res
+
+# Same outcomes as ComplicatedRoll.execute
+@lru_cache(maxsize=cacheSize)
+def rollKeep(amount, size, keep, high):
+    if size == 0 or amount == 0 or keep == 0:
+        return constant(0)
+    checkRoll(amount, size)
+
+    n = abs(amount)
+    # Matches slicing the sorted pool with res[-keep:] or res[:keep]
+    k = min(keep, n) if keep > 0 else max(n + keep, 0)
+    if k == n:
+        return roll(amount, size)
+    if k == 0:
+        return constant(0)
+
+    res = keepHighest(n, size, k)
+    if not high:
+        # The lowest dice are the highest dice of size + 1 - x
+        res = {k * (size + 1) - v: p for v, p in res.items()}
+    return negate(res) if amount < 0 else res
+
+def mean(dist):
+    return sum(v * p for v, p in dist.items())
+
+def deviation(dist):
+    m = mean(dist)
+    return sqrt(max(sum((v - m) ** 2 * p for v, p in dist.items()), 0.0))
+
+def percentiles(dist, points):
+    res = []
+    values = sorted(dist.items())
+    cumulative = 0.0
+    i = 0
+    for point in points:
+        while i < len(values) - 1 and cumulative + values[i][1] < point / 100 - 1e-12:
+            cumulative += values[i][1]
+            i += 1
+        res.append(values[i][0])
+    return res
+
+def number(v):
+    return "{:.6g}".format(v) if isinstance(v, float) else "{}".format(v)
+
+def describe(dist, maxRows=40):
+    msg = "```\nmean {:.2f}, sd {:.2f}\n".format(mean(dist), deviation(dist))
+    points = (5, 25, 50, 75, 95)
+    msg += ", ".join("p{} {}".format(p, number(v)) for p, v in zip(points, percentiles(dist, points))) + "\n"
+    if len(dist) <= maxRows:
+        for v, p in sorted(dist.items()):
+            msg += "{:>6}: {:7.3f}%\n".format(number(v), p * 100)
+    else:
+        msg += "{} outcomes, table omitted\n".format(len(dist))
+    return msg + "```"
@@ -0,0 +1,84 @@
+#!/bin/env python3
+import re
+import sys
+from functools import lru_cache, partial
+
+from ply.lex import LexToken
+
+# Drop-in replacement for a ply.lex.Lexer that scans the whole message in one pass of the
+# master regex PLY built from the t_ rules, and caches the tokens of short messages. Token
+# objects are shared between parses, which is fine because p_error raises instead of
+# letting the parser recover (the only place where it modifies a token). Messages with an
+# illegal character are left to PLY, so the error is raised at the same point as before.
+
+cacheSize = 4096
+maxCached = 200
+
+# Stands in for the lexer in the token functions, t_NEWLINE counts the lines on it
+class Position:
+    def __init__(self):
+        self.lineno = 1
+
+# Returns a function that turns a message into a tuple of tokens, or None if the message
+# contains a character that no rule matches
+def scanner(lexer, interned):
+    # There are few enough rules for PLY to build a single master regex
+    master, index = lexer.lexre[0]
+    ignore = lexer.lexignore
+    regex = re.compile("[{}]*(?:{})".format("".join(map(re.escape, ignore)), master.pattern), master.flags)
+
+    def scan(text):
+        tokens = []
+        pos = 0
+        position = Position()
+        for m in regex.finditer(text):
+            if m.start() != pos:
+                return None
+            pos = m.end()
+            func, type = index[m.lastindex]
+            tok = LexToken()
+            tok.value = m.group(m.lastindex)
+            tok.type = type
+            tok.lineno = position.lineno
+            tok.lexpos = m.start(m.lastindex)
+            if func is not None:
+                tok.lexer = position
+                tok = func(tok)
+                if tok is None:
+                    continue
+                del tok.lexer
+            elif not type:
+                continue
+            if tok.type in interned:
+                tok.value = sys.intern(tok.value)
+            tokens.append(tok)
+        if text[pos:].strip(ignore):
+            return None
+        return tuple(tokens)
+    return scan
+
+class Lexer:
+    # interned lists the token types whose values are interned, like identifiers
+    def __init__(self, lexer, interned=(), scan=None, cached=None):
+        self.lexer = lexer
+        self.interned = interned
+        self.fallback = None
+        if scan is None:
+            scan = scanner(lexer, frozenset(interned))
+            cached = lru_cache(maxsize=cacheSize)(scan)
+        self.scan = scan
+        self.cached = cached
+
+    # Lexers handed out to other parsers share the scanner and its cache
+    def clone(self):
+        return Lexer(self.lexer, self.interned, self.scan, self.cached)
+
+    def input(self, text):
+        tokens = self.cached(text) if len(text) <= maxCached else self.scan(text)
+        if tokens is None:
+            if self.fallback is None:
+                self.fallback = self.lexer.clone()
+            self.fallback.input(text)
+            self.token = self.fallback.token
+        else:
+            self.token = partial(next, iter(tokens), None)
@@ -0,0 +1,99 @@
+#!/bin/env python3
+import re
+
+# Recursive descent parser for messages that are a single dice expression, optionally
+# prefixed with roll. It builds the same trees as the grammar in lex_yacc and returns
+# None for everything else, which is then left to the PLY parser.
+
+# Same token rules as lex_yacc, identifiers and unknown characters end the fast path
+tokenRe = re.compile(r"[ \t\x0c\n]*(?:(\d*\.\d+)|(\d+)|([A-Za-z_][A-Za-z_]\w*)|([-+*/()dhl])|(\S))")
+
+FLOAT, INT, ID, OP, OTHER = range(5)
+
+# Binding power of the binary operators, all of them are left associative
+binding = {"+": 1, "-": 1, "*": 2, "/": 2}
+
+class Fallback(Exception):
+    pass
+
+def tokenize(text):
+    tokens = []
+    pos = 0
+    end = len(text.rstrip(" \t\x0c\n"))
+    while pos < end:
+        m = tokenRe.match(text, pos)
+        if m is None or m.lastindex - 1 == OTHER:
+            return None
+        kind = m.lastindex - 1
+        tokens.append((kind, m.group(m.lastindex)))
+        pos = m.end()
+    return tokens
+
+class Parser:
+    # nodes is the module that defines the expression classes
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.binops = {"+": nodes.Add, "-": nodes.Sub, "*": nodes.Mul, "/": nodes.Div}
+
+    def parse(self, text):
+        tokens = tokenize(text)
+        if tokens is None:
+            return None
+        start = 1 if tokens[:1] == [(ID, "roll")] else 0
+        try:
+            tree, pos = self.expression(tokens, start, 0)
+        except Fallback:
+            return None
+        if pos != len(tokens):
+            return None
+        return tree
+
+    def peek(self, tokens, pos):
+        if pos < len(tokens) and tokens[pos][0] == OP:
+            return tokens[pos][1]
+        return None
+
+    def expression(self, tokens, pos, power):
+        left, pos = self.unary(tokens, pos)
+        while True:
+            op = self.peek(tokens, pos)
+            if op not in binding or binding[op] <= power:
+                return left, pos
+            right, pos = self.expression(tokens, pos + 1, binding[op])
+            left = self.binops[op](left, right)
+
+    # Unary signs bind tighter than every binary operator
+    def unary(self, tokens, pos):
+        op = self.peek(tokens, pos)
+        if op == "-":
+            value, pos = self.unary(tokens, pos + 1)
+            return self.nodes.UnMinus(value), pos
+        if op == "+":
+            return self.unary(tokens, pos + 1)
+        return self.dieroll(tokens, pos)
+
+    def dieroll(self, tokens, pos):
+        amount, pos = self.number(tokens, pos)
+        if self.peek(tokens, pos) != "d":
+            return amount, pos
+        size, pos = self.number(tokens, pos + 1)
+        keep = self.peek(tokens, pos)
+        if keep not in ("h", "l"):
+            return self.nodes.Roll(amount, size), pos
+        count, pos = self.number(tokens, pos + 1)
+        return self.nodes.ComplicatedRoll(amount, size, count, keep == "h"), pos
+
+    def number(self, tokens, pos):
+        if pos >= len(tokens):
+            raise Fallback
+        kind, value = tokens[pos]
+        if kind == INT:
+            return self.nodes.constant(int(value)), pos + 1
+        if kind == FLOAT:
+            return self.nodes.constant(float(value)), pos + 1
+        if kind == OP and value == "(":
+            tree, pos = self.expression(tokens, pos + 1, 0)
+            if self.peek(tokens, pos) != ")":
+                raise Fallback
+            return tree, pos + 1
+        raise Fallback
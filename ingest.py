@@ -0,0 +1,191 @@
+#!/bin/env python3
+import asyncio
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+import weakref
+import urllib.request as url
+
+# ?read as a job that runs on the event loop: the pdf is streamed to disk on a thread,
+# PDFtoJSON runs as a subprocess and the character is loaded once the JSON is there.
+# The converter and the directory can be changed, so the pipeline can be tried with a
+# local HTTP server and a script in place of PDFtoJSON (python bench.py ingest).
+
+converter = os.environ.get("DIEBOT_CONVERTER", "./PDFtoJSON")
+directory = "files"
+# PDFtoJSON is slow and memory hungry, only this many run at the same time
+maxConversions = int(os.environ.get("DIEBOT_CONVERSIONS", "2"))
+chunkSize = 65536
+# Converted sheets are kept by the SHA-256 of the pdf, up to this many bytes in total
+maxCacheBytes = int(os.environ.get("DIEBOT_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+# One semaphore per event loop, asyncio primitives can not be shared between loops
+semaphores = weakref.WeakKeyDictionary()
+
+def conversions():
+    loop = asyncio.get_running_loop()
+    if not loop in semaphores:
+        semaphores[loop] = asyncio.Semaphore(maxConversions)
+    return semaphores[loop]
+
+class IngestError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+# Replaces dest with src, as a hard link where the file system allows it. Renaming a link
+# onto another link of the same file does nothing and would leave tmp behind.
+def place(src, dest):
+    if os.path.exists(dest) and os.path.samefile(src, dest):
+        return
+    tmp = "{}.{}".format(dest, uuid.uuid4().hex)
+    try:
+        try:
+            os.link(src, tmp)
+        except OSError:
+            shutil.copyfile(src, tmp)
+        os.replace(tmp, dest)
+    finally:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+
+# Converted sheets stored as <sha256>.json. The modification time of an entry is its last
+# use, eviction removes the least recently used ones. The sheet of an author is a link to
+# the entry, and <author>.sha256 remembers which one.
+class ConversionCache:
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+
+    # Follows directory, which may be changed after import
+    def folder(self):
+        return os.path.join(directory, "cache")
+
+    def path(self, digest):
+        return os.path.join(self.folder(), "{}.json".format(digest))
+
+    def sheet(self, author):
+        return os.path.join(directory, "{}.json".format(author))
+
+    def pointer(self, author):
+        return os.path.join(directory, "{}.sha256".format(author))
+
+    def assign(self, digest, author):
+        place(self.path(digest), self.sheet(author))
+        with open(self.pointer(author), 'w') as pfile:
+            pfile.write(digest)
+
+    # Gives author the sheet converted from the pdf with this digest, if there is one
+    def fetch(self, digest, author):
+        with self.lock:
+            if not os.path.exists(self.path(digest)):
+                return False
+            os.utime(self.path(digest))
+            self.assign(digest, author)
+            return True
+
+    def store(self, digest, json, author):
+        with self.lock:
+            os.makedirs(self.folder(), exist_ok=True)
+            os.replace(json, self.path(digest))
+            self.assign(digest, author)
+            self.evict()
+
+    # Puts the last sheet read by author back in place from the cache and marks it as used.
+    # Sheets read before the cache existed, or whose entry was evicted, stay as they are.
+    def refresh(self, author):
+        with self.lock:
+            try:
+                with open(self.pointer(author), 'r') as pfile:
+                    digest = pfile.read().strip()
+                os.utime(self.path(digest))
+                self.assign(digest, author)
+            except OSError:
+                pass
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.folder()):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if total <= self.maxBytes:
+                break
+            os.remove(path)
+            total -= size
+
+cache = ConversionCache(maxCacheBytes)
+
+# Streams the pdf to path and returns its SHA-256
+def download(source, path):
+    req = url.Request(
+        source,
+        data = None,
+        headers = {
+            'User-Agent': 'DieRollBot'
+        }
+    )
+    digest = hashlib.sha256()
+    with url.urlopen(req) as pdf, open(path, 'wb') as pfile:
+        while True:
+            chunk = pdf.read(chunkSize)
+            if not chunk:
+                break
+            digest.update(chunk)
+            pfile.write(chunk)
+    return digest.hexdigest()
+
+async def convert(pdf, json):
+    async with conversions():
+        try:
+            proc = await asyncio.create_subprocess_exec(converter, pdf, json)
+        except OSError:
+            raise IngestError("Could not run {}".format(converter))
+        if await proc.wait() != 0:
+            raise IngestError("Could not convert the pdf")
+
+class ReadJob:
+    # load is called with the author once <directory>/<author>.json is in place
+    def __init__(self, author, source, load):
+        self.author = author
+        self.source = source
+        self.load = load
+
+    # Several reads of the same author may run at once, they only share the final file
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        base = os.path.join(directory, "{}.{}".format(self.author, uuid.uuid4().hex))
+        pdf = base + ".pdf"
+        json = base + ".json"
+        try:
+            print(self.source)
+            os.makedirs(directory, exist_ok=True)
+            try:
+                digest = await loop.run_in_executor(None, download, self.source, pdf)
+            except (OSError, ValueError):
+                raise IngestError("Could not download the attachment")
+            # The same pdf was converted before
+            if not await loop.run_in_executor(None, cache.fetch, digest, self.author):
+                await convert(pdf, json)
+                if not os.path.exists(json):
+                    raise IngestError("Could not convert the pdf")
+                await loop.run_in_executor(None, cache.store, digest, json, self.author)
+            try:
+                return await loop.run_in_executor(None, self.load, self.author)
+            except (KeyError, ValueError, OSError):
+                raise IngestError("Could not read the character sheet")
+        except IngestError as e:
+            return e.message
+        finally:
+            for path in (pdf, json):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    # For callers without an event loop
+    def wait(self):
+        return asyncio.run(self.run())
@@ -1,56 +1,153 @@
 #!/bin/env python3
 import ply.lex as lex
-from random import randrange
 from json import load
-import shutil
-import urllib.request as url
-from subprocess import run
 import os
-
-message = ""
-characters = {}
+import sys
+import queue
+import copy
+import weakref
+import threading
+import dice
+import fastparse
+import fastlex
+import cost
+import bytecode
+import procpool
+import ingest
+from parsecache import ParseCache
+import charstore
+import dist
+import sim
+import operator
+from math import isfinite
+
+characters = charstore.CharacterStore(charstore.path, charstore.maxCached)
 charDefs = {}
-
+attributes = {}
+
+# Messages are evaluated on several threads. The definitions and the character of a user
+# are only written while holding the lock of that user, the attributes while holding
+# attributesLock. Readers do a single lookup, which needs no lock.
+userLocks = {}
+userLocksLock = threading.Lock()
+attributesLock = threading.Lock()
+
+def userLock(name):
+    with userLocksLock:
+        if not name in userLocks:
+            userLocks[name] = threading.RLock()
+        return userLocks[name]
+
+parseCache = ParseCache(1024)
+
+# Structurally identical nodes are stored once. Keys hold the ids of the (already shared)
+# children, which stay alive as long as the node that is stored under the key.
+sharedNodes = weakref.WeakValueDictionary()
+sharedLock = threading.Lock()
+
+def hashCons(key, node):
+    with sharedLock:
+        res = sharedNodes.get(key)
+        if res is None:
+            sharedNodes[key] = res = node
+        return res
+
+# Everything the grammar needs to know about the message that is evaluated
+class Context:
+    def __init__(self, author, attachments=(), guild=None):
+        self.author = author
+        self.attachments = attachments
+        self.guild = guild
+        # Set while parsing if the message looked up an identifier
+        self.usedIdentifiers = False
+        # Cost of what was already rolled while parsing, see spend
+        self.spent = cost.constant(0)
+
+# The character is built on the side and then replaces the old one, so readers never
+# see a half loaded character
 def loadFromJSON(name):
-    with open("files/{}.json".format(name), 'rb') as jfile:
+    with open(os.path.join(ingest.directory, "{}.json".format(name)), 'rb') as jfile:
         json = load(jfile)
-        if not name in characters:
-            characters[name] = {}
+        with userLock(name):
+            character = dict(characters.get(name) or {})
 
-        characters[name]["name"] = json["basic_info"]["Character_Name"]
+            character["name"] = json["basic_info"]["Character_Name"]
 
-        characters[name]["fortitude"] = json["savingthrows"]["Fort"]["Total"]
-        characters[name]["reflex"] = json["savingthrows"]["Ref"]["Total"]
-        characters[name]["will"] = json["savingthrows"]["Will"]["Total"]
+            character["fortitude"] = json["savingthrows"]["Fort"]["Total"]
+            character["reflex"] = json["savingthrows"]["Ref"]["Total"]
+            character["will"] = json["savingthrows"]["Will"]["Total"]
 
-        characters[name]["initiative"] = json["stats"]["init"]["total"]
+            character["initiative"] = json["stats"]["init"]["total"]
 
-        for key, value in json["skill"].items():
-            if "Total" in value:
-                characters[name][key.lower()] = value["Total"]
-                print(key, characters[name][key.lower()])
+            for key, value in json["skill"].items():
+                if "Total" in value:
+                    character[key.lower()] = value["Total"]
+                    print(key, character[key.lower()])
 
-        print( characters[name] )
+            print( character )
 
-        return characters[name]["name"]
+            characters.put(name, character)
+            parseCache.invalidate(name)
+            return character["name"]
 
 class SyntaxError(Exception):
     def __init__(self, message):
-        super().__init__()
+        super().__init__(message)
         self.message = message
 
+# The transcript of a roll is only turned into text when the result is displayed.
+# parts may be strings, Transcripts or roll records, empty parts are skipped.
+class Transcript:
+    __slots__ = ("parts", "sep")
+
+    def __init__(self, parts, sep):
+        self.parts = parts
+        self.sep = sep
+
+    def __str__(self):
+        return self.sep.join(filter(None, map(str, self.parts)))
+
+def concat(*parts):
+    return Transcript(parts, "")
+
+class RollRecord:
+    __slots__ = ("res",)
+
+    def __init__(self, res):
+        self.res = res
+
+    def __str__(self):
+        if self.res is None:
+            return "{ Omitted because more than 200 die were rolled }"
+        return "{" + ", ".join(map(str, sorted(self.res))) + "}"
+
+class KeepRecord:
+    __slots__ = ("res", "keep", "high")
+
+    # res is sorted
+    def __init__(self, res, keep, high):
+        self.res = res
+        self.keep = keep
+        self.high = high
+
+    def __str__(self):
+        res = self.res
+        keep = self.keep
+        if res is None:
+            return "{ Omitted because more than 200 die were rolled }"
+        if self.high:
+            return "{~~" + ", ".join(map(str, res[:-keep]))+ "~~, " + ", ".join(map(str, res[-keep:])) + "}"
+        return "{" + ", ".join(map(str, res[:keep]))+ ", ~~" + ", ".join(map(str, res[keep:])) + "~~}"
+
 class RollResult:
+    __slots__ = ("res", "roll")
+
     def __init__(self, res, roll):
         self.res = res
         self.roll = roll
 
     def addStrs(self, other):
-        if not self.roll:
-            return other.roll
-        elif not other.roll:
-            return self.roll
-        else:
-            return self.roll + ", " + other.roll
+        return Transcript((self.roll, other.roll), ", ")
 
     def __add__(self, other):
         if isinstance(other, RollResult):
@@ -99,27 +196,254 @@ class RollResult:
         return "{{{}}}: **{}**".format(self.roll, self.res)
 
 class Math_Element:
+    __slots__ = ("__weakref__",)
+
     def execute(self):
         raise Exception
 
-class Math_Element_Comp:
+    def distribution(self):
+        raise Exception
+
+    def simulate(self, trials):
+        raise Exception
+
+    # Returns an equivalent tree with the same transcript. merge may also change the
+    # transcript, which is fine for callers that never display it.
+    def simplify(self, merge=False):
+        return self
+
+    # True if the result is always an int
+    def integral(self):
+        return False
+
+    # Writes the statements that evaluate this node into gen and returns the python
+    # expressions for its value and its transcript (None if it never has one)
+    def emit(self, gen):
+        node = gen.bind(self)
+        res = gen.assign("{}.execute()".format(node))
+        return "{}.res".format(res), "{}.roll".format(res)
+
+    # Appends the bytecode that leaves the value of this node on the stack
+    def lower(self, asm):
+        raise bytecode.Unsupported("{} has no bytecode form".format(type(self).__name__))
+
+    # Bounds on the value and on the work of executing this node, see cost.py
+    def cost(self):
+        raise cost.CostError("Cannot estimate the cost of this expression")
+
+    # Returns the shared node that is equal to this one. Nodes are never modified once
+    # they are built, only containers like Math_Element_Comp are not shared.
+    def share(self):
+        return self
+
+# Turns an expression tree into the source of a single python function
+class Compiler:
+    def __init__(self):
+        self.lines = []
+        self.names = {}
+        self.count = 0
+
+    def temp(self):
+        self.count += 1
+        return "v{}".format(self.count)
+
+    def line(self, code):
+        self.lines.append("    " + code)
+
+    def assign(self, expr):
+        name = self.temp()
+        self.line("{} = {}".format(name, expr))
+        return name
+
+    # Makes an object available to the generated code under a fresh name
+    def bind(self, obj):
+        name = "c{}".format(len(self.names))
+        self.names[name] = obj
+        return name
+
+def join(*transcripts):
+    transcripts = [t for t in transcripts if t is not None]
+    if len(transcripts) < 2:
+        return transcripts[0] if transcripts else None
+    return "Transcript(({}), \", \")".format(", ".join(transcripts) + ",")
+
+def compileExpression(node):
+    gen = Compiler()
+    value, transcript = node.emit(gen)
+    gen.line("return RollResult({}, {})".format(value, transcript or '""'))
+    source = "def compiled():\n" + "\n".join(gen.lines) + "\n"
+    scope = dict(gen.names, RollResult=RollResult, Transcript=Transcript, concat=concat,
+        rollDice=rollDice, keepDice=keepDice, SyntaxError=SyntaxError)
+    exec(compile(source, "<roll expression>", "exec"), scope)
+    return scope["compiled"]
+
+def constant(value):
+    return Constant(RollResult(value, ""))
+
+# Flattens a tree of Add and Sub into a list of (sign, term)
+def sumTerms(node, sign, terms):
+    while isinstance(node, (Add, Sub)):
+        sumTerms(node.left, sign, terms)
+        if isinstance(node, Sub):
+            sign = -sign
+        node = node.right
+    terms.append((sign, node))
+
+def intConstant(node):
+    return isinstance(node, Constant) and node.integral()
+
+# Joins same sized rolls with a constant amount, 1d6+1d6 becomes 2d6
+def mergeRolls(terms):
+    res = []
+    merged = {}
+    for sign, term in terms:
+        if isinstance(term, Roll) and intConstant(term.amount) and intConstant(term.size) and term.amount.value.res >= 0:
+            key = (sign, term.size.value.res)
+            if key in merged:
+                i = merged[key]
+                res[i] = (sign, Roll(constant(res[i][1].amount.value.res + term.amount.value.res), term.size))
+                continue
+            merged[key] = len(res)
+        res.append((sign, term))
+    return res
+
+class Math_Element_Comp(Math_Element):
+    __slots__ = ("exprs", "compiled")
+
     def __init__(self):
         self.exprs = []
+        self.compiled = None
 
+    # Macros are stored as bytecode, expressions that have no bytecode form stay trees
     def add(self, other):
+        try:
+            other = machine.share(machine.lower(other))
+        except bytecode.Unsupported:
+            other = other.share()
         self.exprs.append(other)
-
+        self.compiled = None
+
+    def tree(self, expr):
+        if isinstance(expr, bytecode.Program):
+            return machine.tree(expr)
+        return expr
+
+    # Shared programs also share the function they are compiled to. A stored macro used
+    # as a macro executes to text, so it is not compiled into the outer one.
+    def function(self, expr):
+        if isinstance(expr, Math_Element_Comp):
+            return expr.execute
+        if not isinstance(expr, bytecode.Program):
+            return compileExpression(expr)
+        if expr.compiled is None:
+            expr.compiled = compileExpression(machine.tree(expr))
+        return expr.compiled
+
+    # Stored macros are executed many times, so they are compiled on first use
     def execute(self):
-        return "\n".join(map(lambda x: "{}".format(x.execute()), self.exprs))
+        if self.compiled is None:
+            self.compiled = [self.function(x) for x in self.exprs]
+        return "\n".join(map(lambda x: "{}".format(x()), self.compiled))
+
+    def distribution(self):
+        if len(self.exprs) != 1:
+            raise dist.DistributionError("Can only compute the distribution of a single expression")
+        return self.tree(self.exprs[0]).distribution()
+
+    def simulate(self, trials):
+        if len(self.exprs) != 1:
+            raise sim.SimulationError("Can only simulate a single expression")
+        return self.tree(self.exprs[0]).simulate(trials)
+
+    def cost(self):
+        return statementCost([self.tree(x) for x in self.exprs])
 
 class Constant(Math_Element):
+    __slots__ = ("value",)
+
     def __init__(self, value):
         self.value = value
 
     def execute(self):
         return self.value
 
+    def integral(self):
+        return isinstance(self.value.res, int)
+
+    # inf and nan have no literal, they are bound like any other object
+    def emit(self, gen):
+        value = self.value.res
+        if type(value) is int or type(value) is float and isfinite(value):
+            value = repr(value)
+        else:
+            value = gen.bind(value)
+        return value, gen.bind(self.value.roll) if self.value.roll else None
+
+    def lower(self, asm):
+        if self.value.roll:
+            raise bytecode.Unsupported("Constant with a transcript")
+        asm.const(self.value.res)
+
+    def cost(self):
+        return cost.Cost(self.value.res, self.value.res, 0, 0, len(str(self.value.roll)))
+
+    # 1 and 1.0 are equal but print differently
+    def share(self):
+        if self.value.roll:
+            return self
+        return hashCons((Constant, type(self.value.res), repr(self.value.res)), self)
+
+    def distribution(self):
+        return dist.constant(self.value.res)
+
+    def simulate(self, trials):
+        return sim.full(trials, self.value.res)
+
+# Returns the total and the transcript record of a roll
+def rollDice(amount, size):
+    amount = int(amount)
+    size = int(size)
+
+    if size == 0 or amount == 0:
+        return 0, ""
+
+    negative = amount < 0
+    amount = abs(amount)
+
+    print("{} {}".format(amount, size))
+    if amount > dice.limit(amount, size):
+        raise SyntaxError("Will not roll more than {:,} dice in one roll".format(dice.limit(amount, size)))
+    res = dice.roll(amount, size)
+    total = dice.total(res)
+    rolls = RollRecord(dice.toList(res) if amount < 200 else None)
+    return -total if negative else total, rolls
+
+def keepDice(amount, size, keep, high):
+    amount = int(amount)
+    size = int(size)
+    keep = int(keep)
+
+    if size == 0 or amount == 0 or keep == 0:
+        return 0, ""
+
+    negative = amount < 0
+    amount = abs(amount)
+
+    print("{} {}".format(amount, size))
+    if amount > dice.limit(amount, size):
+        raise SyntaxError("Will not roll more than {:,} dice in one roll".format(dice.limit(amount, size)))
+    res = dice.roll(amount, size)
+    if(amount >= 200):
+        total = dice.keepTotal(res, keep, high, size)
+        return -total if negative else total, KeepRecord(None, keep, high)
+
+    res = sorted(dice.toList(res))
+    total = sum(res[-keep:] if high else res[:keep])
+    return -total if negative else total, KeepRecord(res, keep, high)
+
 class Roll(Math_Element):
+    __slots__ = ("amount", "size")
+
     def __init__(self, amount, size):
         self.amount = amount
         self.size = size
@@ -127,29 +451,48 @@ class Roll(Math_Element):
     def execute(self):
         tmpamt = self.amount.execute()
         tmpsz = self.size.execute()
-        amount = int(tmpamt.res)
-        size = int(tmpsz.res)
-
-        if size == 0 or amount == 0:
-            return RollResult(0, tmpamt.roll + tmpsz.roll)
-
-        negative = amount < 0
-        amount = abs(amount)
-
-        print("{} {}".format(amount, size))
-        if amount > 1000000:
-            raise SyntaxError("Will not roll more than 1,000,000 dice in one roll")
-        res = []
-        for i in range(0, amount):
-            res.append(randrange(1, size + 1, 1))
-        if(amount < 200):
-            res.sort()
-            rolls = "{" + ", ".join(map(str, res)) + "}"
-        else:
-            rolls = "{ Omitted because more than 200 die were rolled }"
-        return RollResult(-sum(res) if negative else sum(res), tmpamt.roll + tmpsz.roll + rolls)
+        total, rolls = rollDice(tmpamt.res, tmpsz.res)
+        return RollResult(total, concat(tmpamt.roll, tmpsz.roll, rolls))
+
+    def distribution(self):
+        amounts = self.amount.distribution()
+        sizes = self.size.distribution()
+        dist.check(len(amounts) * len(sizes))
+        return dist.mix([(pa * ps, dist.roll(int(a), int(s))) for a, pa in amounts.items() for s, ps in sizes.items()])
+
+    def simulate(self, trials):
+        return sim.roll(self.amount.simulate(trials), self.size.simulate(trials))
+
+    def simplify(self, merge=False):
+        return Roll(self.amount.simplify(merge), self.size.simplify(merge))
+
+    def emit(self, gen):
+        amount, tamount = self.amount.emit(gen)
+        size, tsize = self.size.emit(gen)
+        value, rolls = gen.temp(), gen.temp()
+        gen.line("{}, {} = rollDice({}, {})".format(value, rolls, amount, size))
+        if tamount is None and tsize is None:
+            return value, rolls
+        return value, "concat({}, {}, {})".format(tamount or '""', tsize or '""', rolls)
+
+    def lower(self, asm):
+        self.amount.lower(asm)
+        self.size.lower(asm)
+        asm.op(bytecode.ROLL)
+
+    def cost(self):
+        return cost.roll(self.amount.cost(), self.size.cost())
+
+    def share(self):
+        amount, size = self.amount.share(), self.size.share()
+        return hashCons((Roll, id(amount), id(size)), Roll(amount, size))
+
+    def integral(self):
+        return True
 
 class ComplicatedRoll(Math_Element):
+    __slots__ = ("amount", "size", "keep", "high")
+
     def __init__(self, amount, size, keep, high):
         self.amount = amount
         self.size = size
@@ -160,73 +503,254 @@ class ComplicatedRoll(Math_Element):
         tmpamt = self.amount.execute()
         tmpsz = self.size.execute()
         tmpkp = self.keep.execute()
-        amount = int(tmpamt.res)
-        size = int(tmpsz.res)
-        keep = int(tmpkp.res)
-
-        if size == 0 or amount == 0 or keep == 0:
-            return RollResult(0, tmpamt.roll + tmpsz.roll + tmpkp.roll)
-
-        negative = amount < 0
-        amount = abs(amount)
-
-        print("{} {}".format(amount, size))
-        if amount > 1000000:
-            raise SyntaxError("Will not roll more than 1,000,000 dice in one roll")
-        res = []
-        for i in range(0, amount):
-            res.append(randrange(1, size + 1, 1))
-        res.sort()
-        if self.high:
-            if(amount < 200):
-                rolls = "{~~" + ", ".join(map(str, res[:-keep]))+ "~~, " + ", ".join(map(str, res[-keep:])) + "}"
-            else:
-                rolls = "{ Omitted because more than 200 die were rolled }"
-            return RollResult(-sum(res[-keep:]) if negative else sum(res[-keep:]), tmpamt.roll + tmpsz.roll + tmpkp.roll + rolls)
-
-        else:
-            if(amount < 200):
-                rolls = "{" + ", ".join(map(str, res[:keep]))+ ", ~~" + ", ".join(map(str, res[keep:])) + "~~}"
-            else:
-                rolls = "{ Omitted because more than 200 die were rolled }"
-            return RollResult(-sum(res[:keep]) if negative else sum(res[:keep]), tmpamt.roll + tmpsz.roll + tmpkp.roll + rolls)
+        total, rolls = keepDice(tmpamt.res, tmpsz.res, tmpkp.res, self.high)
+        return RollResult(total, concat(tmpamt.roll, tmpsz.roll, tmpkp.roll, rolls))
+
+    def distribution(self):
+        amounts = self.amount.distribution()
+        sizes = self.size.distribution()
+        keeps = self.keep.distribution()
+        dist.check(len(amounts) * len(sizes) * len(keeps))
+        return dist.mix([(pa * ps * pk, dist.rollKeep(int(a), int(s), int(k), self.high))
+            for a, pa in amounts.items() for s, ps in sizes.items() for k, pk in keeps.items()])
+
+    def simulate(self, trials):
+        return sim.rollKeep(self.amount.simulate(trials), self.size.simulate(trials), self.keep.simulate(trials), self.high)
+
+    def simplify(self, merge=False):
+        return ComplicatedRoll(self.amount.simplify(merge), self.size.simplify(merge), self.keep.simplify(merge), self.high)
+
+    def emit(self, gen):
+        amount, tamount = self.amount.emit(gen)
+        size, tsize = self.size.emit(gen)
+        keep, tkeep = self.keep.emit(gen)
+        value, rolls = gen.temp(), gen.temp()
+        gen.line("{}, {} = keepDice({}, {}, {}, {})".format(value, rolls, amount, size, keep, self.high))
+        if tamount is None and tsize is None and tkeep is None:
+            return value, rolls
+        return value, "concat({}, {}, {}, {})".format(tamount or '""', tsize or '""', tkeep or '""', rolls)
+
+    def lower(self, asm):
+        self.amount.lower(asm)
+        self.size.lower(asm)
+        self.keep.lower(asm)
+        asm.op(bytecode.KEEPH if self.high else bytecode.KEEPL)
+
+    def cost(self):
+        return cost.roll(self.amount.cost(), self.size.cost(), self.keep.cost())
+
+    def share(self):
+        amount, size, keep = self.amount.share(), self.size.share(), self.keep.share()
+        return hashCons((ComplicatedRoll, id(amount), id(size), id(keep), self.high),
+            ComplicatedRoll(amount, size, keep, self.high))
+
+    def integral(self):
+        return True
 
 class Binop(Math_Element):
+    __slots__ = ("left", "right")
+
     def __init__(self, left, right):
         self.left = left
         self.right = right
 
+    def foldable(self, left, right):
+        return True
+
+    # Folds two constants into one, their transcripts are empty
+    def simplify(self, merge=False):
+        left = self.left.simplify(merge)
+        right = self.right.simplify(merge)
+        if isinstance(left, Constant) and isinstance(right, Constant) and self.foldable(left, right):
+            return constant(type(self)(left, right).execute().res)
+        return type(self)(left, right)
+
+    def integral(self):
+        return self.left.integral() and self.right.integral()
+
+    def emit(self, gen):
+        left, tleft = self.left.emit(gen)
+        right, tright = self.right.emit(gen)
+        return "({} {} {})".format(left, self.operator, right), join(tleft, tright)
+
+    def lower(self, asm):
+        self.left.lower(asm)
+        self.right.lower(asm)
+        asm.op(self.opcode)
+
+    def cost(self):
+        return cost.combine(self.left.cost(), self.right.cost(), self.operator)
+
+    def share(self):
+        left, right = self.left.share(), self.right.share()
+        return hashCons((type(self), id(left), id(right)), type(self)(left, right))
+
+# Add and Sub chains of ints are reordered to collect their constants. Constants have no
+# transcript and the other terms keep their order, so the transcript does not change.
+def simplifySum(node, merge):
+    terms = []
+    sumTerms(node, 1, terms)
+    terms = [(sign, term.simplify(merge)) for sign, term in terms]
+    if not all(term.integral() for sign, term in terms):
+        # Float arithmetic is not associative, only fold neighbouring constants
+        return Binop.simplify(node, merge)
+
+    total = sum(sign * term.value.res for sign, term in terms if isinstance(term, Constant))
+    terms = [(sign, term) for sign, term in terms if not isinstance(term, Constant)]
+    if merge:
+        terms = mergeRolls(terms)
+    if not terms:
+        return constant(total)
+
+    sign, res = terms[0]
+    if sign < 0:
+        res = UnMinus(res)
+    for sign, term in terms[1:]:
+        res = Add(res, term) if sign > 0 else Sub(res, term)
+    if total > 0:
+        res = Add(res, constant(total))
+    elif total < 0:
+        res = Sub(res, constant(-total))
+    return res
+
 class Add(Binop):
+    __slots__ = ()
+    operator = "+"
+    opcode = bytecode.ADD
+
     def execute(self):
         return self.left.execute() + self.right.execute()
 
+    def distribution(self):
+        return dist.combine(self.left.distribution(), self.right.distribution(), operator.add)
+
+    def simulate(self, trials):
+        return sim.combine(self.left.simulate(trials), self.right.simulate(trials), operator.add)
+
+    def simplify(self, merge=False):
+        return simplifySum(self, merge)
+
 class Sub(Binop):
+    __slots__ = ()
+    operator = "-"
+    opcode = bytecode.SUB
+
     def execute(self):
         return self.left.execute() - self.right.execute()
 
+    def distribution(self):
+        return dist.combine(self.left.distribution(), self.right.distribution(), operator.sub)
+
+    def simulate(self, trials):
+        return sim.combine(self.left.simulate(trials), self.right.simulate(trials), operator.sub)
+
+    def simplify(self, merge=False):
+        return simplifySum(self, merge)
+
 class Mul(Binop):
+    __slots__ = ()
+    operator = "*"
+    opcode = bytecode.MUL
+
     def execute(self):
         return self.left.execute() * self.right.execute()
 
+    def distribution(self):
+        return dist.combine(self.left.distribution(), self.right.distribution(), operator.mul)
+
+    def simulate(self, trials):
+        return sim.combine(self.left.simulate(trials), self.right.simulate(trials), operator.mul)
+
 class Div(Binop):
+    __slots__ = ()
+    operator = "/"
+
     def execute(self):
         right = self.right.execute()
         if right.res == 0:
             raise SyntaxError("Cannot divide by zero")
         return self.left.execute() / right
 
+    def distribution(self):
+        right = self.right.distribution()
+        if right.get(0, 0.0) > 0:
+            raise dist.DistributionError("Cannot divide by zero")
+        return dist.combine(self.left.distribution(), right, operator.truediv)
+
+    def simulate(self, trials):
+        right = self.right.simulate(trials)
+        return sim.divide(self.left.simulate(trials), right)
+
+    # Division by zero has to keep failing when the roll is executed
+    def foldable(self, left, right):
+        return right.value.res != 0
+
+    # True division gives a float even for int operands
+    def integral(self):
+        return False
+
+    # Like execute, the divisor is rolled first
+    def emit(self, gen):
+        right, tright = self.right.emit(gen)
+        if not right.isidentifier():
+            right = gen.assign(right)
+        gen.line("if {} == 0: raise SyntaxError(\"Cannot divide by zero\")".format(right))
+        left, tleft = self.left.emit(gen)
+        return "({} / {})".format(left, right), join(tleft, tright)
+
+    def lower(self, asm):
+        self.right.lower(asm)
+        asm.op(bytecode.NONZERO)
+        self.left.lower(asm)
+        asm.op(bytecode.DIV)
+
+    def cost(self):
+        return cost.divide(self.left.cost(), self.right.cost(), self.right.integral())
+
 class UnMinus(Math_Element):
+    __slots__ = ("value",)
+
     def __init__(self, value):
         self.value = value
 
     def execute(self):
         return -self.value.execute()
 
+    def distribution(self):
+        return dist.negate(self.value.distribution())
+
+    def simulate(self, trials):
+        return sim.negate(self.value.simulate(trials))
+
+    def simplify(self, merge=False):
+        value = self.value.simplify(merge)
+        if isinstance(value, Constant):
+            return constant(-value.value.res)
+        return UnMinus(value)
+
+    def integral(self):
+        return self.value.integral()
+
+    def emit(self, gen):
+        value, transcript = self.value.emit(gen)
+        return "(-{})".format(value), transcript
+
+    def lower(self, asm):
+        self.value.lower(asm)
+        asm.op(bytecode.NEG)
+
+    def cost(self):
+        return cost.negate(self.value.cost())
+
+    def share(self):
+        value = self.value.share()
+        return hashCons((UnMinus, id(value)), UnMinus(value))
+
 
 
 
 reserved = (
-    'READ', 'REREAD', 'HELP', 'LOADCON', 'ROLL', 'DMINIT',
+    'READ', 'REREAD', 'HELP', 'LOADCON', 'ROLL', 'DMINIT', 'DIST', 'SIM',
 )
 
 tokens = reserved + (
@@ -281,6 +805,8 @@ def t_error(t):
     raise SyntaxError("Illegal character {}".format(t.value[0]))
 
 lexer = lex.lex()
+# Scans whole messages at once and interns identifiers, see fastlex.py
+fastLexer = fastlex.Lexer(lexer, ("COMMAND",))
 
 import ply.yacc as yacc
 
@@ -292,72 +818,77 @@ precedence = (
     ('right', 'UMINUS', 'UPLUS')
 )
 
+# A line is a list of statements. Roll expressions are kept as trees and only executed
+# once the whole line is parsed, every other statement is already a string.
+# The statement lists are left recursive, so the parser stack does not grow with the
+# number of statements and the results are appended in order
 def p_line1(p):
-    'line : expression SEMICOLON line'
-    p[0] = "{}\n{}".format(p[1], p[3])
+    '''line : statements
+            | statements SEMICOLON'''
+    p[0] = p[1]
 
 def p_line2(p):
-    '''line : expression
-            | expression SEMICOLON'''
-    p[0] = "{}".format(p[1])
+    '''line : definition
+            | statements SEMICOLON definition'''
+    if len(p) == 2:
+        p[0] = [p[1]]
+    else:
+        p[0] = p[1]
+        p[0].append(p[3])
+
+def p_statements1(p):
+    'statements : statements SEMICOLON expression'
+    p[0] = p[1]
+    p[0].append(p[3])
+
+def p_statements2(p):
+    'statements : expression'
+    p[0] = [p[1]]
 
 def p_line3(p):
-    'line : COMMAND EQUALS m_expression_list'
-    try:
-        if p[1] in attributes:
-            p[0] = "Error: Could not overwrite predefined command {}".format(p[1])
-            return
-    except NameError:
-        pass
-    name = "{}".format(message.author)
-    if not name in charDefs:
-        charDefs[name] = {}
-    retmsg = ""
-    if p[1] in charDefs[name]:
-        retmsg = "Warning: redecleration of identifier {}".format(p[1])
-    else:
-        retmsg = "Declared identifier {} for {}".format(p[1], message.author)
-    charDefs[name][p[1]] = p[3]
+    'definition : COMMAND EQUALS m_expression_list'
+    if p[1] in attributes:
+        p[0] = "Error: Could not overwrite predefined command {}".format(p[1])
+        return
+    name = p.parser.context.author
+    with userLock(name):
+        if not name in charDefs:
+            charDefs[name] = {}
+        retmsg = ""
+        if p[1] in charDefs[name]:
+            retmsg = "Warning: redecleration of identifier {}".format(p[1])
+        else:
+            retmsg = "Declared identifier {} for {}".format(p[1], name)
+        charDefs[name][p[1]] = p[3]
+        parseCache.invalidate(name)
     p[0] = retmsg
 
 def p_m_expression_list(p):
-    'm_expression_list : m_expression SEMICOLON m_expression_list'
-    p[0] = p[3]
-    p[0].add(p[1])
+    '''m_expression_list : m_expression_list SEMICOLON m_expression
+                         | m_expression_list SEMICOLON'''
+    p[0] = p[1]
+    if len(p) == 4:
+        p[0].add(p[3].simplify())
 
 def p_m_expression_list2(p):
-    '''m_expression_list : m_expression
-                         | m_expression SEMICOLON'''
+    'm_expression_list : m_expression'
     p[0] = Math_Element_Comp()
-    p[0].add(p[1])
+    p[0].add(p[1].simplify())
 
 def p_read_expression(p):
     'expression : READ'
-    p[0] = "Called read"
-    if len(message.attachments) == 1:
-        with open("files/{}.pdf".format(message.author), 'wb') as pfile:
-            print(message.attachments[0].url)
-            req = url.Request(
-                message.attachments[0].url,
-                data = None,
-                headers = {
-                    'User-Agent': 'DieRollBot'
-                }
-            )
-            with url.urlopen(req) as pdf:
-                shutil.copyfileobj(pdf, pfile)
-
-        run(["./PDFtoJSON", "files/{}.pdf".format(message.author), "files/{}.json".format(message.author)])
-
-        os.remove("files/{}.pdf".format(message.author))
-
-        p[0] = loadFromJSON("{}".format(message.author))
+    context = p.parser.context
+    if len(context.attachments) == 1:
+        # Downloading and converting happens after parsing, see ingest.py
+        p[0] = ingest.ReadJob(context.author, context.attachments[0].url, loadFromJSON)
     else:
         p[0] = "Could not find attachment"
 
 def p_reread_expression(p):
     'expression : REREAD'
-    p[0] = loadFromJSON("{}".format(message.author))
+    context = p.parser.context
+    ingest.cache.refresh(context.author)
+    p[0] = loadFromJSON(context.author)
 
 def p_help_expression(p):
     'expression : HELP'
@@ -365,6 +896,8 @@ def p_help_expression(p):
 read: Reads the attached pdf
 reread: Loads the last pdf you send with read
 roll: Evaluates a roll expression.
+dist: Shows the exact probabilities of a roll expression
+sim: Rolls an expression many times, sim 10000 1d20+5, 15 also shows the chance to reach 15
 loadcon: loads a configuration
 
 Dicerolling: examples:
@@ -379,7 +912,9 @@ def p_loadcon_expression(p):
     try:
         with open("cfgs/{}.com".format(p[3].replace("/", "#")), 'r') as pfile:
             global attributes
-            attributes = dict([(x.split()[0], x.split()[1]) for x in pfile if " " in x])
+            with attributesLock:
+                attributes = dict([(x.split()[0], x.split()[1]) for x in pfile if " " in x])
+                parseCache.clear()
         p[0] = "Succesfully read config {}".format(p[3])
         print(attributes)
     except IOError:
@@ -388,11 +923,36 @@ def p_loadcon_expression(p):
 
 def p_roll_expression(p):
     'expression : ROLL m_expression'
-    p[0] = p[2].execute()
+    p[0] = p[2].simplify().share()
+
+def p_dist_expression(p):
+    'expression : DIST m_expression'
+    try:
+        p[0] = dist.describe(p[2].simplify(True).distribution())
+    except dist.DistributionError as e:
+        raise SyntaxError(e.message)
+
+def simulate(context, trials, expr, target=None):
+    if trials < 1 or trials > sim.maxTrials:
+        raise SyntaxError("Can only simulate between 1 and {:,} trials".format(sim.maxTrials))
+    spend(context, [expr], trials)
+    try:
+        return sim.summary(expr.simplify(True).simulate(trials), target)
+    except sim.SimulationError as e:
+        raise SyntaxError(e.message)
+
+def p_sim_expression1(p):
+    'expression : SIM INTL m_expression'
+    p[0] = simulate(p.parser.context, int(p[2]), p[3])
+
+def p_sim_expression2(p):
+    'expression : SIM INTL m_expression COMMA m_expression'
+    spend(p.parser.context, [p[5]])
+    p[0] = simulate(p.parser.context, int(p[2]), p[3], p[5].execute().res)
 
 def p_dminit_expression1(p):
     'expression : DMINIT'
-    results = [(x["name"], randrange(1, 21, 1) + int(x["initiative"])) for x in characters.values()]
+    results = [(x["name"], dice.source.die(20) + int(x["initiative"])) for x in characters.party()]
     results.sort(key = lambda x: x[1], reverse = True)
     p[0] = "```\n"
     for x in results:
@@ -401,9 +961,10 @@ def p_dminit_expression1(p):
 
 def p_dminit_expression2(p):
     'expression : DMINIT LBRACK arglist RBRACK'
-    results = [(x["name"], randrange(1, 21, 1) + int(x["initiative"])) for x in characters.values()]
+    spend(p.parser.context, p[3])
+    results = [(x["name"], dice.source.die(20) + int(x["initiative"])) for x in characters.party()]
     for x in range(1, len(p[3]) + 1):
-        results.append(("Enemy {}".format(x), randrange(1, 21, 1) + p[3][x-1].execute().res))
+        results.append(("Enemy {}".format(x), dice.source.die(20) + p[3][x-1].execute().res))
     results.sort(key = lambda x: x[1], reverse = True)
     p[0] = "```\n"
     for x in results:
@@ -422,30 +983,26 @@ def p_arg_list2(p):
 
 def p_command_expression1(p):
     'm_expression : COMMAND'
-    name = "{}".format(message.author)
-
-    try:
-        if not p[1] in attributes:
-            if name in charDefs:
-                if p[1] in charDefs[name]:
-                    p[0] = charDefs[name][p[1]]
-                    return
-            raise SyntaxError("Unknown identifier {}".format(p[1]))
-    except NameError:
-        if name in charDefs:
-            if p[1] in charDefs[name]:
-                p[0] = charDefs[name][p[1]]
-                return
+    p.parser.context.usedIdentifiers = True
+    name = p.parser.context.author
+    attrs = attributes
+
+    if not p[1] in attrs:
+        defs = charDefs.get(name, {})
+        if p[1] in defs:
+            p[0] = defs[p[1]]
+            return
         raise SyntaxError("Unknown identifier {}".format(p[1]))
 
-    if not "{}".format(message.author) in characters:
-        raise SyntaxError("Could not find char of {}".format(message.author))
-    #p[0] = randrange(1, 21, 1) + int(characters["{}".format(message.author)].get(attributes[p[1]], "-20"))
-    p[0] = Add(Roll(Constant(RollResult(1, "")), Constant(RollResult(20, ""))), Constant(RollResult(int(characters["{}".format(message.author)].get(attributes[p[1]], "-20")), "")))
+    character = characters.get(name)
+    if character is None:
+        raise SyntaxError("Could not find char of {}".format(name))
+    #p[0] = randrange(1, 21, 1) + int(character.get(attrs[p[1]], "-20"))
+    p[0] = Add(Roll(Constant(RollResult(1, "")), Constant(RollResult(20, ""))), Constant(RollResult(int(character.get(attrs[p[1]], "-20")), "")))
 
 def p_m_expression_expression(p):
     'expression : m_expression'
-    p[0] = p[1].execute()
+    p[0] = p[1].simplify().share()
 
 def p_m_expression1(p):
     '''m_expression : m_expression PLUS m_expression
@@ -504,7 +1061,136 @@ def p_error(p):
     print("Syntax error {}".format(p))
     raise SyntaxError("Syntax error near {}".format(p))
 
-parser = yacc.yacc(debug=True)
+# The tables are only rebuilt when the grammar changes, pass debug=True to get parser.out
+parser = yacc.yacc(tabfile=os.path.join(os.path.dirname(os.path.abspath(__file__)), "parsetab.pickle"))
+
+# Combined cost of the lines of a message, each line also shows its result
+def statementCost(statements):
+    total = cost.constant(0)
+    for x in statements:
+        if isinstance(x, Math_Element):
+            line = x.cost()
+            markup = cost.resultMarkup + len(str(max(abs(line.lo), abs(line.hi))))
+            total = cost.Cost(line.lo, line.hi, total.dice + line.dice, total.work + line.work,
+                total.transcript + line.transcript + markup)
+    return total
+
+def addCost(x, y):
+    return cost.Cost(y.lo, y.hi, x.dice + y.dice, x.work + y.work, x.transcript + y.transcript)
+
+# Rejects messages that could roll too many dice before any of them is rolled. spent is
+# the cost of what the message rolled while it was parsed.
+def admit(statements, spent=None):
+    try:
+        total = statementCost(statements)
+        if spent is not None:
+            total = addCost(spent, total)
+        cost.check(total)
+    except cost.CostError as e:
+        raise SyntaxError(e.message)
+
+# Some statements roll while the line is parsed, like the enemies of dminit or the trials
+# of sim. Their cost is checked before they are rolled and counts towards the cost of the
+# whole message.
+def spend(context, exprs, trials=1):
+    try:
+        total = statementCost(exprs)
+        if trials != 1:
+            total = cost.repeat(total, trials)
+        context.spent = addCost(context.spent, total)
+        cost.check(context.spent)
+    except cost.CostError as e:
+        raise SyntaxError(e.message)
+
+# Bytecode of a statement, or None if part of it can only be executed as a tree
+def programs(x):
+    if isinstance(x, Math_Element_Comp):
+        if all(isinstance(expr, bytecode.Program) for expr in x.exprs):
+            return list(x.exprs)
+        return None
+    try:
+        return [machine.lower(x)]
+    except bytecode.Unsupported:
+        return None
+
+# Expensive statements are sent to the process pool if there is one
+def execute(x):
+    if procpool.pool is not None and x.cost().heavy():
+        code = programs(x)
+        if code is not None:
+            try:
+                return "\n".join(map(str, procpool.run(code)))
+            except procpool.WorkerError as e:
+                raise SyntaxError(e.message)
+    return x.execute()
+
+# Yields the result of every statement as soon as it is evaluated. Jobs like reading a
+# character sheet are yielded as they are, the caller runs them.
+def results(statements, spent=None):
+    admit(statements, spent)
+    for x in statements:
+        if isinstance(x, ingest.ReadJob):
+            yield x
+        else:
+            yield "{}".format(execute(x) if isinstance(x, Math_Element) else x)
+
+def run(statements, spent=None):
+    return "\n".join(x.wait() if isinstance(x, ingest.ReadJob) else x for x in results(statements, spent))
+
+# LRParser and Lexer keep their state on the instance, so every evaluation borrows its own
+# pair. They share the tables of the module level parser and lexer.
+class ParserPool:
+    def __init__(self, parser, lexer):
+        self.parser = parser
+        self.lexer = lexer
+        self.idle = queue.SimpleQueue()
+
+    def parse(self, text, context):
+        try:
+            parser, lexer = self.idle.get_nowait()
+        except queue.Empty:
+            parser, lexer = copy.copy(self.parser), self.lexer.clone()
+        parser.context = context
+        try:
+            return parser.parse(text, lexer=lexer)
+        finally:
+            parser.context = None
+            self.idle.put((parser, lexer))
+
+parsers = ParserPool(parser, fastLexer)
+fastParser = fastparse.Parser(sys.modules[__name__])
+machine = bytecode.Machine(sys.modules[__name__])
+
+# Returns the statements of a line, plain dice arithmetic does not need PLY
+def parse(text, context):
+    tree = fastParser.parse(text)
+    if tree is not None:
+        return [tree.simplify().share()]
+    return parsers.parse(text, context)
+
+# Parses a message. Lines that only consist of roll expressions are cached as trees, so
+# the next identical message skips lexing and parsing.
+def prepare(text, context):
+    key = ParseCache.normalize(text)
+    context.spent = cost.constant(0)
+    statements = parseCache.get(key, context.author)
+    if statements is None:
+        context.usedIdentifiers = False
+        generation = parseCache.generation(context.author)
+        statements = parse(text, context)
+        if all(isinstance(x, Math_Element) for x in statements):
+            parseCache.put(key, context.author if context.usedIdentifiers else None, statements, generation)
+    if parseCache.lookups() % 1000 == 0:
+        print(parseCache)
+    return statements
+
+def evaluate(text, context):
+    return run(prepare(text, context), context.spent)
+
+# Like evaluate, but yields the result of each statement. Parse errors are raised right
+# away, errors while rolling when the statement is reached.
+def stream(text, context):
+    return results(prepare(text, context), context.spent)
 
 if __name__ == "__main__":
     while True:
@@ -513,5 +1199,5 @@ if __name__ == "__main__":
         except EOFError:
             break
         if not s: continue
-        result = parser.parse(s)
+        result = evaluate(s, Context("console"))
         print(result)
@@ -2,20 +2,69 @@
 import discord
 
 import lex_yacc as ly
+import procpool
+import ingest
 
 import os
 
-from asyncio import Lock
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+# Seconds between edits of a reply that is still being evaluated
+editInterval = 1.0
+
+# Messages are evaluated on these threads, the event loop only awaits the results
+workers = int(os.environ.get("DIEBOT_WORKERS", "4"))
+# How many messages may wait for a free worker before new ones are turned away
+queueDepth = int(os.environ.get("DIEBOT_QUEUE", "32"))
+# Worker processes for expensive rolls, 0 rolls everything in this process
+processes = int(os.environ.get("DIEBOT_PROCESSES", str(os.cpu_count() or 1)))
+
+# Measures how late the event loop wakes up from a sleep. Anything that blocks the loop,
+# and with it the discord heartbeat, shows up here.
+class LagMonitor:
+    def __init__(self, interval, reportInterval):
+        self.interval = interval
+        self.reportInterval = reportInterval
+        self.samples = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.worst = 0.0
+
+    async def run(self):
+        reported = time.monotonic()
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.last = time.monotonic() - start - self.interval
+            self.worst = max(self.worst, self.last)
+            self.total += self.last
+            self.samples += 1
+            if time.monotonic() - reported > self.reportInterval:
+                print(self)
+                reported = time.monotonic()
+
+    def __str__(self):
+        mean = self.total / self.samples if self.samples else 0.0
+        return "Event loop lag: last {:.1f} ms, mean {:.1f} ms, worst {:.1f} ms over {} samples".format(
+            self.last * 1000, mean * 1000, self.worst * 1000, self.samples)
 
 class DieBot(discord.Client):
     def __init__(self):
         super().__init__()
-        self.lock = Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="evaluate")
+        self.slots = asyncio.Semaphore(workers + queueDepth)
+        self.lag = LagMonitor(0.5, 600)
+        self.lagTask = None
 
     async def on_ready(self):
         game = discord.Game("with a lot of dice")
         await bot.change_presence(activity=game)
 
+        if self.lagTask is None:
+            self.lagTask = asyncio.ensure_future(self.lag.run())
+
         print('Logged on as: ', self.user)
 
     async def on_message(self, message):
@@ -28,22 +77,54 @@ class DieBot(discord.Client):
         if message.content == '?ping':
             return await message.channel.send('pong')
 
+        if message.content == '?lag':
+            return await message.channel.send(str(self.lag))
+
         if message.content[0] != '?':
             return
 
-        result = "Error"
+        if self.slots.locked():
+            return await message.channel.send("Too many rolls at once, try again in a moment")
 
-        async with self.lock:
-            ly.message = message
-            ly.message.author.name.replace("/", "#")
-            result = ""
+        # Every message gets its own context, lex_yacc locks the state it writes
+        guild = message.guild.id if message.guild is not None else None
+        context = ly.Context("{}".format(message.author), message.attachments, guild)
+        loop = asyncio.get_event_loop()
+        lines = []
+        reply = None
+        edited = 0
+        async with self.slots:
             try:
-                result = ly.parser.parse(message.content[1:])
+                # Parsing and every statement run on a worker. The first result is sent
+                # right away, long scripts then edit the reply.
+                results = await loop.run_in_executor(self.executor, ly.stream, message.content[1:], context)
+                while True:
+                    line = await loop.run_in_executor(self.executor, next, results, None)
+                    if line is None:
+                        break
+                    if isinstance(line, ingest.ReadJob):
+                        line = await line.run()
+                    lines.append(line)
+                    if reply is None:
+                        reply = await message.channel.send("\n".join(lines))
+                        edited = len(lines)
+                        editedAt = time.monotonic()
+                    elif time.monotonic() - editedAt > editInterval:
+                        await reply.edit(content="\n".join(lines))
+                        edited = len(lines)
+                        editedAt = time.monotonic()
             except ly.SyntaxError as e:
-                result = e.message
+                lines.append(e.message)
+
+        if reply is None:
+            await message.channel.send("\n".join(lines))
+        elif edited < len(lines):
+            await reply.edit(content="\n".join(lines))
 
-        await message.channel.send(result)
+# The worker processes import this module again, they must not start a bot
+if __name__ == "__main__":
+    procpool.start(processes)
 
-bot = DieBot()
+    bot = DieBot()
 
-bot.run(os.environ['DISCORD_TOKEN'])
+    bot.run(os.environ['DISCORD_TOKEN'])
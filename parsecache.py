@@ -0,0 +1,67 @@
+#!/bin/env python3
+from collections import OrderedDict
+from threading import Lock
+
+# Maps the normalized text of a message to the expression trees it parses to.
+# Entries that looked up an identifier depend on the author and are keyed by it.
+# Every invalidation bumps a generation, so a message that was parsed while the
+# definitions changed is not stored.
+class ParseCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.generations = {}
+        self.cleared = 0
+        # Messages are parsed on several threads at once
+        self.lock = Lock()
+
+    @staticmethod
+    def normalize(text):
+        return " ".join(text.split())
+
+    def get(self, text, author):
+        with self.lock:
+            for key in ((text, None), (text, author)):
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return self.entries[key]
+            self.misses += 1
+            return None
+
+    def generation(self, author):
+        with self.lock:
+            return (self.cleared, self.generations.get(author, 0))
+
+    def put(self, text, author, trees, generation):
+        key = (text, author)
+        with self.lock:
+            if author is not None and generation != (self.cleared, self.generations.get(author, 0)):
+                return
+            self.entries[key] = trees
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    # Drops everything that depends on the definitions or the character of author
+    def invalidate(self, author):
+        with self.lock:
+            self.generations[author] = self.generations.get(author, 0) + 1
+            for key in [k for k in self.entries if k[1] == author]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.cleared += 1
+            self.entries.clear()
+
+    def lookups(self):
+        return self.hits + self.misses
+
+    def hitRate(self):
+        return self.hits / self.lookups() if self.lookups() else 0.0
+
+    def __str__(self):
+        return "Parse cache: {} entries, {:.1%} hit rate over {} lookups".format(len(self.entries), self.hitRate(), self.lookups())
@@ -64,7 +64,9 @@
 import re
 import types
 import sys
+import os
 import inspect
+import pickle
 
 #-----------------------------------------------------------------------------
 #                     === User configurable parameters ===
@@ -76,6 +78,7 @@ yaccdebug   = False            # Debugging mode.  If set, yacc generates a
                                # a 'parser.out' file in the current directory
 
 debug_file  = 'parser.out'     # Default name of the debugging file
+tab_version = 1                # Version of the format written by write_tables()
 error_count = 3                # Number of symbols that must be shifted to leave recovery mode
 resultlimit = 40               # Size limit of results when running in debug mode.
 
@@ -1301,6 +1304,35 @@ class LALRError(YaccError):
     pass
 
 
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# class MiniProduction:
+#
+# The subset of a Production that the parsing engine needs.  This is what gets
+# stored in a table file, the function is bound again by name when it is read.
+# -----------------------------------------------------------------------------
+
+class MiniProduction(object):
+    def __init__(self, str, name, len, func, file, line):
+        self.name     = name
+        self.len      = len
+        self.func     = func
+        self.callable = None
+        self.file     = file
+        self.line     = line
+        self.str      = str
+
+    def __str__(self):
+        return self.str
+
+    def __repr__(self):
+        return 'MiniProduction(%s)' % self.str
+
+    # Bind the production function name to a callable
+    def bind(self, pdict):
+        if self.func:
+            self.callable = pdict[self.func]
+
 # -----------------------------------------------------------------------------
 #                             == LRTable ==
 #
@@ -1345,6 +1377,21 @@ class LRTable:
         for p in self.lr_productions:
             p.bind(pdict)
 
+    # Write the parsing tables to filename, tagged with the grammar signature
+    def write_tables(self, filename, signature):
+        productions = [(p.str, p.name, p.len, p.func, os.path.basename(p.file), p.line) for p in self.lr_productions]
+        data = {
+            'version': tab_version,
+            'signature': signature,
+            'action': self.lr_action,
+            'goto': self.lr_goto,
+            'productions': productions,
+        }
+        tmpname = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmpname, 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpname, filename)
+
     # Compute the LR(0) closure operation on I, where I is a set of LR(0) items.
 
     def lr0_closure(self, I):
@@ -1929,6 +1976,37 @@ class LRTable:
 # introspection features followed by the yacc() function itself.
 # -----------------------------------------------------------------------------
 
+# -----------------------------------------------------------------------------
+#                             == LRTableCache ==
+#
+# Parsing tables read back from a file written by LRTable.write_tables().  It
+# offers the same attributes as LRTable to LRParser.
+# -----------------------------------------------------------------------------
+
+class LRTableCache:
+    def __init__(self):
+        self.lr_action = None
+        self.lr_goto = None
+        self.lr_productions = None
+
+    # Returns False if the file is missing or was made for another grammar
+    def read_tables(self, filename, signature):
+        try:
+            with open(filename, 'rb') as f:
+                data = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False
+        if not isinstance(data, dict) or data.get('version') != tab_version or data.get('signature') != signature:
+            return False
+        self.lr_action = data['action']
+        self.lr_goto = data['goto']
+        self.lr_productions = [MiniProduction(*p) for p in data['productions']]
+        return True
+
+    def bind_callables(self, pdict):
+        for p in self.lr_productions:
+            p.bind(pdict)
+
 # -----------------------------------------------------------------------------
 # get_caller_module_dict()
 #
@@ -2270,7 +2348,7 @@ class ParserReflect(object):
 
 def yacc(*, debug=yaccdebug, module=None, start=None,
          check_recursion=True, optimize=False, debugfile=debug_file,
-         debuglog=None, errorlog=None):
+         debuglog=None, errorlog=None, tabfile=None):
 
     # Reference to the parsing method of the last built parser
     global parse
@@ -2303,6 +2381,20 @@ def yacc(*, debug=yaccdebug, module=None, start=None,
     if pinfo.error:
         raise YaccError('Unable to build parser')
 
+    # If the tables of this exact grammar were written before, skip building them
+    signature = pinfo.signature()
+    if tabfile and not debug:
+        lr = LRTableCache()
+        if lr.read_tables(tabfile, signature):
+            try:
+                lr.bind_callables(pinfo.pdict)
+            except KeyError:
+                pass
+            else:
+                parser = LRParser(lr, pinfo.error_func)
+                parse = parser.parse
+                return parser
+
     if debuglog is None:
         if debug:
             try:
@@ -2474,6 +2566,12 @@ def yacc(*, debug=yaccdebug, module=None, start=None,
                 errorlog.warning('Rule (%s) is never reduced', rejected)
                 warned_never.append(rejected)
 
+    if tabfile:
+        try:
+            lr.write_tables(tabfile, signature)
+        except OSError as e:
+            errorlog.warning("Couldn't write %r. %s" % (tabfile, e))
+
     # Build the parser
     lr.bind_callables(pinfo.pdict)
     parser = LRParser(lr, pinfo.error_func)
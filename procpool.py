@@ -0,0 +1,64 @@
+#!/bin/env python3
+import multiprocessing
+import random
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Expressions that are estimated to be expensive (see cost.heavyWork) are executed in
+# worker processes, so they do not hold the GIL of the process that talks to discord.
+# A worker gets the serialized bytecode of the expressions and a seed for its dice, and
+# sends back the RollResults.
+
+pool = None
+processes = 0
+lock = threading.Lock()
+
+# Raised when a worker died while it was rolling, the pool is restarted
+class WorkerError(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+# processes == 0 keeps everything in this process
+def start(count):
+    global pool, processes
+    with lock:
+        if pool is not None:
+            pool.shutdown()
+            pool = None
+        processes = count
+        if count > 0:
+            # The parent runs threads, which do not mix well with fork
+            pool = ProcessPoolExecutor(count, multiprocessing.get_context("spawn"), initializer=prepare)
+
+def stop():
+    start(0)
+
+# Imports lex_yacc (and loads the parser tables) before the first expression arrives
+def prepare():
+    import lex_yacc
+
+def execute(programs, seed):
+    import lex_yacc as ly
+    ly.dice.seed(seed)
+    return [ly.machine.run(ly.machine.loads(data)) for data in programs]
+
+# A pool stays broken once one of its workers was killed, every thread that notices
+# replaces it, unless another thread already did
+def restart(broken):
+    global pool
+    with lock:
+        if pool is broken:
+            broken.shutdown(wait=False)
+            pool = ProcessPoolExecutor(processes, multiprocessing.get_context("spawn"), initializer=prepare)
+
+# Runs the programs in a worker and waits for their results. The roll is not repeated if
+# the worker dies, it may well be what killed it.
+def run(programs):
+    current = pool
+    try:
+        return current.submit(execute, [x.dumps() for x in programs], random.getrandbits(64)).result()
+    except BrokenProcessPool:
+        restart(current)
+        raise WorkerError("The roll was interrupted, try again")
@@ -0,0 +1,164 @@
+#!/bin/env python3
+from collections import Counter
+import operator
+
+import dice
+
+np = dice.np
+
+maxTrials = 1000000
+maxDice = 50000000
+# Per-face counts of histogram pools, one count costs about as much as a few dice
+maxCounts = 10000000
+# Trials are rolled in chunks of about this many dice, so a simulation never holds all of
+# its dice at once
+chunkDice = 1000000
+histogramRows = 20
+
+class SimulationError(Exception):
+    def __init__(self, message):
+        super().__init__()
+        self.message = message
+
+# Results are numpy arrays with one entry per trial, or lists if numpy is not installed
+
+def full(trials, value):
+    if np is not None:
+        return np.full(trials, value)
+    return [value] * trials
+
+def truncate(values):
+    if np is not None:
+        return np.trunc(values).astype(np.int64)
+    return [int(x) for x in values]
+
+# Groups the trials by their (amount, size, ...) so every group can be rolled in one batch
+def groups(*columns):
+    if np is not None and all((c == c[0]).all() for c in columns):
+        return {tuple(int(c[0]) for c in columns): slice(None)}
+    res = {}
+    for i, key in enumerate(zip(*(c.tolist() if np is not None else c for c in columns))):
+        res.setdefault(key, []).append(i)
+    return res
+
+def checkDice(amount, trials, size):
+    if size < 0:
+        raise SimulationError("Cannot roll dice with a negative number of sides")
+    if amount * trials > maxDice:
+        raise SimulationError("Will not roll more than {:,} dice in one simulation".format(maxDice))
+
+# Calls f with the number of trials of each chunk, width is the number of values a trial
+# takes, and joins the results
+def chunked(trials, width, f):
+    rows = max(1, chunkDice // max(width, 1))
+    if trials <= rows:
+        return f(trials)
+    parts = [f(min(rows, trials - i)) for i in range(0, trials, rows)]
+    if np is not None:
+        return np.concatenate(parts)
+    return [x for part in parts for x in part]
+
+def pools(amount, size, trials):
+    if np is not None:
+        return dice.source.block(trials, amount, size)
+    return [dice.source.dice(amount, size) for j in range(trials)]
+
+def sums(amount, size, trials):
+    if np is not None and amount >= size and dice.histogram(amount, size) and trials * size <= maxCounts:
+        # Per-face counts keep the memory independent of the amount of dice. With more
+        # counts than maxCounts the pool is rolled die by die below, which checkDice bounds.
+        faces = np.arange(1, size + 1)
+        return chunked(trials, size, lambda n: dice.source.counts(amount, size, n) @ faces)
+    checkDice(amount, trials, size)
+    if np is not None:
+        return chunked(trials, amount, lambda n: pools(amount, size, n).sum(axis=1))
+    return chunked(trials, amount, lambda n: [sum(pool) for pool in pools(amount, size, n)])
+
+def keptSums(amount, size, keep, high, trials):
+    checkDice(amount, trials, size)
+    return chunked(trials, amount, lambda n: keptChunk(amount, size, keep, high, n))
+
+def keptChunk(amount, size, keep, high, trials):
+    res = pools(amount, size, trials)
+    if np is not None:
+        res = np.sort(res, axis=1)
+        return (res[:, -keep:] if high else res[:, :keep]).sum(axis=1)
+    res = [sorted(pool) for pool in res]
+    return [sum(pool[-keep:] if high else pool[:keep]) for pool in res]
+
+def scatter(trials, parts):
+    res = np.zeros(trials, dtype=np.int64) if np is not None else [0] * trials
+    for indices, values in parts:
+        if np is not None:
+            res[indices] = values
+        else:
+            for i, v in zip(indices, values):
+                res[i] = v
+    return res
+
+def roll(amounts, sizes):
+    trials = len(amounts)
+    parts = []
+    for (amount, size), indices in groups(truncate(amounts), truncate(sizes)).items():
+        if size == 0 or amount == 0:
+            continue
+        values = sums(abs(amount), size, trials if indices == slice(None) else len(indices))
+        parts.append((indices, -values if amount < 0 else values))
+    return scatter(trials, parts)
+
+def rollKeep(amounts, sizes, keeps, high):
+    trials = len(amounts)
+    parts = []
+    for (amount, size, keep), indices in groups(truncate(amounts), truncate(sizes), truncate(keeps)).items():
+        if size == 0 or amount == 0 or keep == 0:
+            continue
+        values = keptSums(abs(amount), size, keep, high, trials if indices == slice(None) else len(indices))
+        parts.append((indices, -values if amount < 0 else values))
+    return scatter(trials, parts)
+
+def combine(left, right, op):
+    if np is not None:
+        return op(left, right)
+    return [op(x, y) for x, y in zip(left, right)]
+
+def divide(left, right):
+    if any(x == 0 for x in right):
+        raise SimulationError("Cannot divide by zero")
+    return combine(left, right, operator.truediv)
+
+def negate(values):
+    if np is not None:
+        return -values
+    return [-x for x in values]
+
+def number(v):
+    return "{:.4g}".format(v) if isinstance(v, float) else "{}".format(v)
+
+def summary(values, target=None):
+    values = sorted(values.tolist() if np is not None else values)
+    trials = len(values)
+    mean = sum(values) / trials
+    sd = (sum((v - mean) ** 2 for v in values) / trials) ** 0.5
+    msg = "```\n{} trials: mean {:.2f}, sd {:.2f}, min {}, max {}\n".format(trials, mean, sd, number(values[0]), number(values[-1]))
+    if target is not None:
+        hits = trials - next((i for i, v in enumerate(values) if v >= target), trials)
+        msg += "P(>= {}) = {:.2f}%\n".format(number(target), hits * 100 / trials)
+
+    counts = Counter(values)
+    if len(counts) <= histogramRows:
+        rows = [(number(v), counts[v]) for v in sorted(counts)]
+    else:
+        low, high = values[0], values[-1]
+        integral = all(isinstance(v, int) for v in (low, high))
+        width = -(-(high - low + 1) // histogramRows) if integral else (high - low) / histogramRows
+        counts = [0] * histogramRows
+        for v in values:
+            counts[min(int((v - low) // width), histogramRows - 1)] += 1
+        if integral:
+            rows = [("{}..{}".format(low + i * width, low + (i + 1) * width - 1), c) for i, c in enumerate(counts) if low + i * width <= high]
+        else:
+            rows = [("{}..{}".format(number(low + i * width), number(low + (i + 1) * width)), c) for i, c in enumerate(counts)]
+    label = max(len(r[0]) for r in rows)
+    for name, count in rows:
+        msg += "{:>{}}: {:6.2f}% {}\n".format(name, label, count * 100 / trials, "#" * round(count * 40 / trials))
+    return msg + "```"